@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fonial import PARSERS
+
+# the fixtures are hand-made after the structure of the portal pages, not recorded from the portal: the parity check
+# of the backends below only covers this markup
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# (fixture, extractor) pairs covering every page the Fonial client scrapes
+CASES = [
+    ("login.html", lambda p, html: p.input_value(html, name="_csrf_token")),
+    ("landing.html", lambda p, html: p.title(html)),
+    ("devices.html", lambda p, html: p.device_rows(html)),
+    ("device_edit.html", lambda p, html: p.form_fields(html)),
+    ("device_edit.html", lambda p, html: p.input_value(html, id="fonial_frontend_device_ip_device__token")),
+    ("number_activate.html", lambda p, html: p.input_value(html, id="form__token")),
+    ("number_edit.html", lambda p, html: p.input_value(html, id="fonial_databundle_number__token")),
+    ("switch_number.html", lambda p, html: p.input_value(html, id="fonial_frontend_system_number__token")),
+]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='compare the html parser backends on hand-made copies of the fonial portal pages')
+    parser.add_argument('-n', '--number', type=int, default=50,
+                        help='calls per extractor (default 50)')
+    args = parser.parse_args()
+
+    backends = []
+    for name in PARSERS:
+        try:
+            PARSERS[name]()
+            backends.append(name)
+        except ImportError:
+            pass  # optional backend not installed
+    print("{:<22} {:<14}".format("page", "extractor") + "".join("{:>14}".format(name) for name in backends))
+    for fixture, extract in CASES:
+        with open(os.path.join(FIXTURES, fixture), 'rb') as f:
+            html = f.read()
+        results = {}
+        timings = []
+        for name in backends:
+            p = PARSERS[name]()
+            results[name] = extract(p, html)
+            timings.append(timeit.timeit(lambda: extract(p, html), number=args.number) / args.number)
+        # every backend has to extract exactly the same data
+        assert len({repr(r) for r in results.values()}) == 1, results
+        label = extract.__code__.co_names[-1]
+        print("{:<22} {:<14}".format(fixture, label) + "".join("{:>11.2f} ms".format(t * 1000) for t in timings))
@@ -0,0 +1,292 @@
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# hand-made pages with the forms and tables of the portal pages the client scrapes
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# CSRF tokens of the fixture pages per form name
+TOKENS = {
+    "login": "kXH1Pz0cLq6g3T1bQkS0x8VqQO9gS8uQ1nD4h2xk0Jc",
+    "fonial_frontend_device_ip_device": "d1Q4mXoVw5e8Zk2tH7bR0cJ9sLpN3aUyF6gKqE1iTzo",
+    "form": "Ab3dE5fG7hI9jK1lM3nO5pQ7rS9tU1vW3xY5zA7bC9d",
+    "fonial_databundle_number": "Qw2eR4tY6uI8oP0aS2dF4gH6jK8lZ0xC2vB4nM6qW8e",
+    "fonial_frontend_system_number": "Zy9xW7vU5tS3rQ1pO9nM7lK5jI3hG1fE9dC7bA5zY3x",
+}
+
+DEVICE_CREATED = '["\\/system\\/device\\/#ip"]'
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def set_value(html, id, value):
+    return re.sub(r'(id="{}"[^>]* value=")[^"]*(")'.format(re.escape(id)), lambda m: m.group(1) + str(value) + m.group(2), html)
+
+class Inventory:
+    # in-memory stand-in for the numbers and devices of one fonial account
+    def __init__(self, numbers, devices, account="123456"):
+        self.account = account
+        self.lock = threading.Lock()
+        self.numbers = {}
+        self.devices = {}
+        self.next_device = 70000
+        for i in range(numbers):
+            self.numbers[str(5000 + i)] = {"id": str(5000 + i), "number": "+49 301{:06d}".format(i), "type": "VOICE",
+                                           "state": i < devices or i % 4 == 0, "cancel_at": None, "targets": []}
+        for i in range(min(devices, numbers)):
+            self.add_device("Mitarbeiter {:05d}".format(i), "000413{:06X}".format(0xA00000 + i), str(5000 + i))
+
+    def add_device(self, name, mac_address, outboundnum, internalext=None):
+        number = self.numbers.get(outboundnum)
+        device = {"id": str(self.next_device), "name": name, "mac": mac_address, "outboundnum": outboundnum,
+                  "internalext": internalext if internalext is not None else int(number["number"][-3:]) if number else 0}
+        self.next_device += 1
+        self.devices[device["id"]] = device
+        if number:
+            number["targets"].append(device["id"])
+        return device
+
+    def remove_device(self, id):
+        device = self.devices.pop(id, None)
+        if device:
+            for number in self.numbers.values():
+                if id in number["targets"]:
+                    number["targets"].remove(id)
+        return device
+
+class Portal(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, inventory, latency=0.0, jitter=0.0, error_rate=0.0, session_ttl=0):
+        super().__init__(address, PortalHandler)
+        self.inventory = inventory
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.sessions = {}
+        self.pages = {name[:-5]: fixture(name) for name in os.listdir(FIXTURES) if name.endswith(".html")}
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+class PortalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive like the real portal
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logging.debug("fake portal: " + format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET", {})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        self.dispatch("POST", {k: v[0] for k, v in parse_qs(body, keep_blank_values=True).items()})
+
+    def send(self, body, status=200, content_type="text/html; charset=UTF-8", headers=None):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, body):
+        self.send(body if isinstance(body, str) else json.dumps(body), content_type="application/json")
+
+    def session_id(self):
+        match = re.search(r'PHPSESSID=([^;]+)', self.headers.get("Cookie") or "")
+        return match.group(1) if match else None
+
+    def dispatch(self, method, form):
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send("Service Unavailable", status=503)
+
+        path = self.path.split("?")[0]
+        if path == "/login":
+            return self.send(server.pages["login"])
+        if path == "/login_check" and method == "POST":
+            if form.get("_csrf_token") != TOKENS["login"] or not form.get("_username") or not form.get("_password"):
+                return self.send(server.pages["login"])
+            session = uuid.uuid4().hex
+            server.sessions[session] = time.monotonic()
+            return self.send(server.pages["landing"], headers={"Set-Cookie": "PHPSESSID={}; path=/; HttpOnly".format(session)})
+
+        started = server.sessions.get(self.session_id())
+        if started is None or (server.session_ttl and time.monotonic() - started > server.session_ttl):
+            return self.send("", status=302, headers={"Location": "/login"})
+
+        with server.inventory.lock:
+            for pattern, handler in ROUTES:
+                match = re.fullmatch(pattern, path)
+                if match and (handler.__name__.startswith(method.lower()) or handler.__name__.startswith("any")):
+                    return handler(self, form, *match.groups())
+        self.send("not found", status=404)
+
+    def get_landing(self, form):
+        self.send(self.server.pages["landing"])
+
+    def token_valid(self, form_name, form):
+        return form.get("{}[_token]".format(form_name)) == TOKENS[form_name]
+
+    def post_numbers(self, form):
+        inventory = self.server.inventory
+        numbers = sorted(inventory.numbers.values(), key=lambda n: (not n["state"], n["number"]))
+        start, length = int(form.get("start", 0)), int(form.get("length", 10))
+        self.send_json({"draw": int(form.get("draw", 1)), "recordsTotal": len(numbers), "recordsFiltered": len(numbers),
+                        "data": [dict(n, DT_RowId=n["id"]) for n in numbers[start:start + length]]})
+
+    def post_devices(self, form):
+        inventory = self.server.inventory
+        rows = "\n".join('                <tr id="{id}"><td><input type="checkbox" name="device[]" value="{id}"></td><td>{name}</td>'
+                         '<td>{mac}</td><td>Snom D715</td><td>{number}</td><td><a href="/system/device/{id}/ipdevice/edit">Bearbeiten</a></td></tr>'
+                         .format(number=inventory.numbers[d["outboundnum"]]["number"] if d["outboundnum"] in inventory.numbers else "", **d)
+                         for d in inventory.devices.values())
+        page = self.server.pages["devices"]
+        self.send(re.sub(r'<tbody>.*</tbody>', lambda m: "<tbody>\n{}\n            </tbody>".format(rows), page, flags=re.S))
+
+    def device_form(self, device):
+        page = self.server.pages["device_edit"]
+        number = self.server.inventory.numbers.get(device["outboundnum"]) if device else None
+        option = '<option value="{}" selected="selected">{}</option>'.format(number["id"], number["number"]) if number else ""
+        page = re.sub(r'(id="fonial_frontend_device_ip_device_outboundnum"[^>]*>).*?(</select>)', lambda m: m.group(1) + option + m.group(2), page, flags=re.S)
+        page = set_value(page, "fonial_frontend_device_ip_device_targetName", device["name"] if device else "")
+        page = set_value(page, "fonial_frontend_device_ip_device_mac", device["mac"] if device else "")
+        return set_value(page, "fonial_frontend_device_ip_device_internalext", device["internalext"] if device else "")
+
+    def get_new_device(self, form):
+        self.send(self.device_form(None))
+
+    def post_create_device(self, form):
+        if not self.token_valid("fonial_frontend_device_ip_device", form):
+            return self.send(self.device_form(None))
+        field = lambda name: form.get("fonial_frontend_device_ip_device[{}]".format(name), "")
+        self.server.inventory.add_device(field("targetName"), field("mac"), field("outboundnum"), int(field("internalext") or 0))
+        self.send_json(DEVICE_CREATED)
+
+    def get_edit_device(self, form, id):
+        device = self.server.inventory.devices.get(id)
+        if not device:
+            return self.send("not found", status=404)
+        self.send(self.device_form(device))
+
+    def post_update_device(self, form, id):
+        device = self.server.inventory.devices.get(id)
+        if not device:
+            return self.send("not found", status=404)
+        if not self.token_valid("fonial_frontend_device_ip_device", form):
+            return self.send(self.device_form(device))
+        field = lambda name: form.get("fonial_frontend_device_ip_device[{}]".format(name), "")
+        device.update(name=field("targetName"), mac=field("mac"), outboundnum=field("outboundnum"), internalext=int(field("internalext") or 0))
+        self.send_json(DEVICE_CREATED)
+
+    def post_delete_device(self, form, id):
+        self.server.inventory.remove_device(id)
+        self.send_json(DEVICE_CREATED)
+
+    def post_number_state_form(self, form, id, action):
+        if id not in self.server.inventory.numbers:
+            return self.send("not found", status=404)
+        self.send(self.server.pages["number_activate"].replace("/5042/update/activate", "/{}/update/{}".format(id, action)))
+
+    def post_number_state(self, form, id, action):
+        number = self.server.inventory.numbers.get(id)
+        if not number:
+            return self.send("not found", status=404)
+        if not self.token_valid("form", form):
+            return self.send(self.server.pages["number_activate"])
+        number["state"] = action == "activate"
+        self.send_json(json.dumps("/system/number/{}/update/{}/success".format(id, action)))
+
+    def post_number_edit(self, form, id):
+        self.send(self.server.pages["number_edit"])
+
+    def post_number_update(self, form, id):
+        number = self.server.inventory.numbers.get(id)
+        if not number:
+            return self.send("not found", status=404)
+        if not self.token_valid("fonial_databundle_number", form):
+            return self.send(self.server.pages["number_edit"])
+        target = form.get("fonial_databundle_number[settings][0][targets][0][target]")
+        number["targets"] = [target] if target else []
+        self.send_json("{}")
+
+    def post_switch_number(self, form, id):
+        numbers = self.server.inventory.numbers
+        if "fonial_frontend_system_number[_token]" not in form:
+            return self.send(self.server.pages["switch_number"])
+        if not self.token_valid("fonial_frontend_system_number", form):
+            return self.send(self.server.pages["switch_number"])
+        source = numbers.get(form.get("fonial_frontend_system_number[unassign]"))
+        destination = numbers.get(form.get("fonial_frontend_system_number[assign]"))
+        if not source or not destination or not source["state"] or destination["state"]:
+            return self.send_json({"error": "switch not possible"})
+        # the destination takes over targets and devices of the source which gets inactive
+        destination["targets"], source["targets"] = source["targets"], []
+        destination["state"], source["state"] = True, False
+        for device in self.server.inventory.devices.values():
+            if device["outboundnum"] == source["id"]:
+                device["outboundnum"] = destination["id"]
+        self.send_json("{}")
+
+ROUTES = [
+    (r"/", PortalHandler.get_landing),
+    (r"/system/number/json", PortalHandler.post_numbers),
+    (r"/system/device/", PortalHandler.post_devices),
+    (r"/system/device/ipdevice/new", PortalHandler.get_new_device),
+    (r"/system/device/create", PortalHandler.post_create_device),
+    (r"/system/device/(\d+)/ipdevice/edit", PortalHandler.get_edit_device),
+    (r"/system/device/(\d+)/update", PortalHandler.post_update_device),
+    (r"/system/device/(\d+)/delete", PortalHandler.post_delete_device),
+    (r"/system/number/(\d+)/(activate|deactivate)", PortalHandler.post_number_state_form),
+    (r"/system/number/(\d+)/update/(activate|deactivate)", PortalHandler.post_number_state),
+    (r"/system/number/(\d+)/edit/number", PortalHandler.post_number_edit),
+    (r"/system/number/(\d+)/update", PortalHandler.post_number_update),
+    (r"/system/number/(\d+)/switch/number", PortalHandler.post_switch_number),
+]
+
+def start(numbers=10000, devices=2000, latency=0.0, jitter=0.0, error_rate=0.0, session_ttl=0, port=0):
+    portal = Portal(("127.0.0.1", port), Inventory(numbers, devices), latency, jitter, error_rate, session_ttl)
+    threading.Thread(target=portal.serve_forever, daemon=True).start()
+    return portal
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='local stand-in for the fonial portal')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on (default 8080)')
+    parser.add_argument('--numbers', type=int, default=10000,
+                        help='number of phone numbers in the account (default 10000)')
+    parser.add_argument('--devices', type=int, default=2000,
+                        help='number of devices in the account (default 2000)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='mean response latency in seconds (default 0.05)')
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='standard deviation of the response latency in seconds (default 0.01)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with 503 (default 0)')
+    parser.add_argument('--session-ttl', type=float, default=0,
+                        help='seconds until a login session expires, 0 for never (default 0)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    portal = Portal(("127.0.0.1", args.port), Inventory(args.numbers, args.devices), args.latency, args.jitter, args.error_rate, args.session_ttl)
+    logging.info("serving {} numbers and {} devices on {}".format(args.numbers, args.devices, portal.base_url))
+    portal.serve_forever()
@@ -0,0 +1,116 @@
+import argparse
+import csv
+import logging
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from openpyxl import Workbook
+
+import fake_portal
+from fonial import Fonial, build_parser, run as run_command
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def write_csv(path, rows):
+    with open(path, 'w', encoding='utf-8-sig', newline='') as dst:
+        writer = csv.writer(dst, delimiter=';', quotechar='"')
+        writer.writerow(["Name", "Number", "Extension", "Mac-Address", "Model", "Previous number"])
+        writer.writerows(rows)
+
+def write_mapping_workbook(path, inventory, count, extensions=True):
+    # same layout as the inventory workbook: name, number, extension and mac address in columns 7-10
+    wb = Workbook()
+    ws = wb.active
+    ws.append([""] * 7 + ["Name", "Number", "Extension", "Mac-Address"])
+    for i, d in enumerate(list(inventory.devices.values())[:count]):
+        number = inventory.numbers[d["outboundnum"]]["number"][4:]
+        ws.append([""] * 7 + [d["name"] if i % 10 else d["name"] + " (old)", number, d["internalext"] if extensions else None, d["mac"]])
+    wb.save(path)
+
+def prepare(directory, inventory, devices, rows):
+    numbers = list(inventory.numbers.values())
+    inactive = [n for n in numbers[devices:] if not n["state"]]
+    files = {
+        "export": os.path.join(directory, "export.xlsx"),
+        "verify": os.path.join(directory, "mapping.xlsx"),
+        "provision": os.path.join(directory, "new_devices.csv"),
+        "switch": os.path.join(directory, "switch_numbers.csv"),
+        "clean": os.path.join(directory, "clean.xlsx"),
+    }
+    write_mapping_workbook(files["verify"], inventory, rows)
+    # every device keeps its row, so the clean up only deactivates the unassigned numbers; the 3-digit extensions of
+    # all devices repeat across the blocks of 1000 numbers and are left out
+    write_mapping_workbook(files["clean"], inventory, devices, extensions=False)
+    write_csv(files["provision"], [["Neu {:05d}".format(i), n["number"][4:], n["number"][-3:], "000414{:06X}".format(i), "D715", ""]
+                                     for i, n in enumerate(inactive[:rows])])
+    write_csv(files["switch"], [["", destination["number"][4:], "", "", "", source["number"][4:]]
+                                        for source, destination in zip(numbers[:rows], inactive[rows:2 * rows])])
+    return files
+
+def run(name, args, files):
+    # runs the command the same way the command line does, including the pre-flight checks of the sheet
+    args = build_parser().parse_args([name] + args + [files[name]])
+    f = Fonial(args)
+    latencies = []
+    f.session.hooks["response"].append(lambda r, *a, **k: latencies.append(r.elapsed.total_seconds()))
+
+    started = time.perf_counter()
+    error = None
+    try:
+        run_command(f)
+        if f.failed:
+            error = "{} actions failed".format(len(f.failed))
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+        logging.debug(traceback.format_exc())
+    elapsed = time.perf_counter() - started
+    return elapsed, latencies, error
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='end to end benchmark of the fonial commands against the fake portal')
+    parser.add_argument('--numbers', type=int, default=10000,
+                        help='number of phone numbers in the fake account (default 10000)')
+    parser.add_argument('--devices', type=int, default=2000,
+                        help='number of devices in the fake account (default 2000)')
+    parser.add_argument('--rows', type=int, default=200,
+                        help='rows per bulk command input file (default 200)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='mean response latency of the fake portal in seconds (default 0.02)')
+    parser.add_argument('--jitter', type=float, default=0.005,
+                        help='standard deviation of the response latency in seconds (default 0.005)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests the fake portal answers with 503 (default 0)')
+    parser.add_argument('--session-ttl', type=float, default=0,
+                        help='seconds until a fake portal session expires, 0 for never (default 0)')
+    parser.add_argument('--commands', nargs='+', default=["export", "verify", "provision", "switch", "clean"],
+                        help='commands to run in this order')
+    parser.add_argument('fonial_args', nargs=argparse.REMAINDER,
+                        help='extra arguments for the fonial client, e.g. -- --workers 16 --rate 0')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    portal = fake_portal.start(args.numbers, args.devices, args.latency, args.jitter, args.error_rate, args.session_ttl)
+    extra = [a for a in args.fonial_args if a != "--"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = prepare(directory, portal.inventory, args.devices, args.rows)
+        client_args = ["-a", portal.inventory.account, "-u", "bench@example.com", "-p", "secret", "--base-url", portal.base_url,
+                       "--cache-dir", os.path.join(directory, "cache"),
+                       "--session-dir", os.path.join(directory, "sessions"), "--refresh"] + extra
+
+        print("{:<28} {:>9} {:>9} {:>9} {:>9} {:>9}  {}".format("command", "seconds", "requests", "req/s", "p50 ms", "p95 ms", "error"))
+        for name in args.commands:
+            elapsed, latencies, error = run(name, client_args, files)
+            print("{:<28} {:>9.2f} {:>9} {:>9.1f} {:>9.1f} {:>9.1f}  {}".format(
+                name, elapsed, len(latencies), len(latencies) / elapsed if elapsed else 0,
+                percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, error or ""))
+
+    portal.shutdown()
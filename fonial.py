@@ -1,218 +1,1088 @@
 import argparse
 import csv
+import hashlib
 import json
 import logging
 import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from getpass import getpass
-from openpyxl import Workbook, load_workbook
-
-import requests
-from bs4 import BeautifulSoup
+from urllib.parse import urlsplit
+
+# requests, bs4, openpyxl and lxml are imported where they are needed, so --help and local commands start fast
+
+# spreadsheet columns: field -> (accepted header names, column in workbooks, column in csv files without those headers)
+COLUMNS = {
+    "name": (("name",), 7, 0),
+    "number": (("number", "phone number", "rufnummer"), 8, 1),
+    "extension": (("extension", "durchwahl"), 9, 2),
+    "mac_address": (("mac-address", "mac address", "mac"), 10, 3),
+    "status": (("status", "action"), 13, None),
+    "previous_number": (("previous number", "old number", "alte rufnummer"), None, 5),
+}
+
+def read_sheet(path):
+    # streams the rows of a xlsx workbook (read-only mode) or a ';' separated csv file as {field: value} dicts
+    if path.lower().endswith(".csv"):
+        src = open(path, 'r', encoding='utf-8-sig', newline='')
+        rows, close, fallback = csv.reader(src, delimiter=';', quotechar='"'), src.close, 2
+    else:
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        rows, close, fallback = wb.active.iter_rows(values_only=True), wb.close, 1
+    try:
+        header = [str(h).strip().lower() if h is not None else "" for h in next(rows, [])]
+        columns = {field: next((i for i, h in enumerate(header) if h in spec[0]), None) for field, spec in COLUMNS.items()}
+        if all(i is None for i in columns.values()):
+            # no known header at all: a sheet in the fixed layout, a header we do not know never falls back to a position
+            columns = {field: spec[fallback] for field, spec in COLUMNS.items()}
+        logging.debug("reading columns {} from {}".format(columns, path))
+        for line, row in enumerate(rows, 2):
+            values = {field: cell(row, i) for field, i in columns.items()}
+            if any(v is not None for v in values.values()):
+                values["row"] = line
+                yield values
+    finally:
+        close()
+
+def read_columns(path):
+    # the whole sheet at once as {field: [value of every row]} for checks over complete columns
+    columns = {field: [] for field in list(COLUMNS) + ["row"]}
+    for row in read_sheet(path):
+        for field, value in row.items():
+            columns[field].append(value)
+    return columns
+
+def duplicates(lines, values, label):
+    # one problem per value found in more than one row
+    rows = {}
+    for line, value in zip(lines, values):
+        if value is not None:
+            rows.setdefault(value, []).append(line)
+    return ["rows {}: {} {} used {} times".format(", ".join(map(str, found)), label, value, len(found)) for value, found in rows.items() if len(found) > 1]
+
+def cell(row, i):
+    if i is None or i >= len(row):
+        return None
+    value = row[i]
+    if isinstance(value, str):
+        value = value.strip()
+    return None if value == "" else value
+
+def as_text(value):
+    # numbers typed into excel come back as int or float
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return None if value is None else str(value)
+
+def as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class FonialError(Exception):
+    pass
+
+def expect(condition, message, *args):
+    # checks an answer of the portal - unlike an assert this survives python -O and can be handled by the caller
+    if not condition:
+        raise FonialError(message.format(*args))
+
+def answered(response):
+    # the portal answers a processed form post with a short JSON body, anything else renders an html page
+    return response.status_code == 200 and not response.text.lstrip().startswith("<")
+
+def succeeded(response, path):
+    # the JSON string "\/system\/number\/4711\/update\/activate\/success"
+    return answered(response) and response.text.strip().strip('"').replace("\\/", "/") == path
+
+def number_extension(number):
+    # the 3-digit extension of a phone number - e.g. 678
+    return int(str(number)[-3:])
+
+MAC_ADDRESS = re.compile(r"[0-9A-F]{12}")
+
+def normalize_mac(value):
+    # 00:04:13:a0:00:2a, 00-04-13-A0-00-2A and 000413a0002a are the same device
+    if value is None:
+        return None
+    return "".join(c for c in str(value) if c.isalnum()).upper()
 
 class Employee:
-    def __init__(self, name, number, extension, mac_address, fonial_number, fonial_device):
+    __slots__ = ("name", "number", "extension", "mac_address", "fonial_number", "fonial_device", "status", "previous_number")
+
+    def __init__(self, name, number, extension, mac_address, fonial_number, fonial_device, status=None, previous_number=None):
         self.name = name
         self.number = str(number)
         self.extension = extension
         self.mac_address = mac_address
         self.fonial_number = fonial_number
         self.fonial_device = fonial_device
+        self.status = status
+        self.previous_number = previous_number
 
     def __str__(self):
         return "{}, {} ({}), {} with fonial device {} and number {}".format(self.name, self.number, self.extension, self.mac_address, self.fonial_device, self.fonial_number)
 
 class FonialDevice:
-    def __init__(self, id, mac_address):
+    __slots__ = ("id", "mac_address", "name", "type")
+
+    def __init__(self, id, mac_address, name=None, type=None):
         self.id = id
         self.mac_address = mac_address
+        self.name = name
+        self.type = type
+
+    def record(self):
+        return {"id": self.id, "mac_address": self.mac_address, "name": self.name, "type": self.type}
 
     def __str__(self):
         return "{}: {}".format(self.id, self.mac_address)
 
 class FonialNumber:
-    def __init__(self, id, number, type, state, cancelled, assigned):
+    __slots__ = ("id", "number", "extension", "type", "state", "cancelled", "assigned", "targets")
+
+    def __init__(self, id, number, type, state, cancelled, assigned, targets=None):
         self.id = id
         self.number = str(number)
-        self.extension = int(self.number[-3:])
+        self.extension = number_extension(self.number)
         self.type = type
         self.state = state
         self.cancelled = cancelled
         self.assigned = assigned
+        self.targets = targets or []  # ids of the devices the number is routed to
+
+    def record(self):
+        return {"id": self.id, "number": self.number, "type": self.type, "state": self.state, "cancelled": self.cancelled, "assigned": self.assigned, "targets": self.targets}
 
     def __str__(self):
         return "{}: {} {} ({}) {}".format(self.id, self.type, self.number, "cancelled" if self.cancelled else self.state, "assigned" if self.assigned else "not assigned")
 
+class Inventory:
+    # the numbers and devices of the account with secondary indexes that are kept up to date on every change
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear_numbers()
+        self.clear_devices()
+
+    def clear_numbers(self):
+        with self.lock:
+            self.numbers = {}       # id -> FonialNumber
+            self.by_number = {}     # number -> FonialNumber
+            self.by_extension = {}  # extension -> [FonialNumber]
+            self.by_target = {}     # device id -> FonialNumber routed to it
+            self.indexed = {}       # id -> (extension, targets) the number was indexed with
+            self.unused = set()     # ids of active, unassigned and not cancelled numbers
+
+    def clear_devices(self):
+        with self.lock:
+            self.devices = {}  # id -> FonialDevice
+            self.by_mac = {}   # normalized mac address -> FonialDevice
+
+    def add_number(self, n):
+        with self.lock:
+            if n.id in self.numbers:
+                self.remove_number(self.numbers[n.id])
+            self.numbers[n.id] = n
+            self.by_number[n.number] = n
+            self.by_extension.setdefault(n.extension, []).append(n)
+            for t in n.targets:
+                self.by_target[t] = n
+            self.indexed[n.id] = (n.extension, list(n.targets))
+            if n.state and not n.assigned and not n.cancelled:
+                self.unused.add(n.id)
+
+    def remove_number(self, n):
+        with self.lock:
+            self.numbers.pop(n.id, None)
+            self.by_number.pop(n.number, None)
+            extension, targets = self.indexed.pop(n.id, (n.extension, n.targets))
+            same = self.by_extension.get(extension, [])
+            if n in same:
+                same.remove(n)
+            for t in targets:
+                if self.by_target.get(t) is n:
+                    del self.by_target[t]
+            self.unused.discard(n.id)
+
+    def update_number(self, n):
+        # re-index a number after its state or targets changed
+        self.add_number(n)
+
+    def add_device(self, d):
+        with self.lock:
+            self.devices[d.id] = d
+            self.by_mac[normalize_mac(d.mac_address)] = d
+
+    def remove_device(self, d):
+        # returns the number the device was unbound from
+        with self.lock:
+            self.devices.pop(d.id, None)
+            self.by_mac.pop(normalize_mac(d.mac_address), None)
+            n = self.by_target.pop(d.id, None)
+            if n is not None:
+                n.targets = [t for t in n.targets if t != d.id]
+                n.assigned = bool(n.targets)
+                self.update_number(n)
+            return n
+
+    def device_by_mac(self, mac_address):
+        return self.by_mac.get(normalize_mac(mac_address))
+
+    def number_of_device(self, d):
+        return self.by_target.get(d.id)
+
+    def numbers_with_extension(self, extension):
+        with self.lock:
+            return list(self.by_extension.get(extension, []))
+
+    def unused_numbers(self):
+        with self.lock:
+            return [self.numbers[id] for id in self.unused]
+
+class Action:
+    __slots__ = ("kind", "subject", "fn", "args")
+
+    # one step of a sync plan
+    def __init__(self, kind, subject, fn, *args):
+        self.kind = kind
+        self.subject = subject
+        self.fn = fn
+        self.args = args
+
+    def __call__(self):
+        return self.fn(*self.args)
+
+    def __str__(self):
+        return "{:<10} {}".format(self.kind, self.subject)
+
+class SoupParser:
+    # targeted extractors for the portal pages on top of BeautifulSoup's pure python html.parser
+    name = "html.parser"
+
+    def __init__(self):
+        from bs4 import BeautifulSoup
+        self.BeautifulSoup = BeautifulSoup
+
+    def soup(self, html):
+        return self.BeautifulSoup(html, 'html.parser')
+
+    def title(self, html):
+        return self.soup(html).title.string
+
+    def form_name(self, html):
+        form = self.soup(html).form
+        return form.get("name") if form else None
+
+    def input_value(self, html, id=None, name=None):
+        tag = self.soup(html).find("input", {"id": id} if id else {"name": name})
+        return tag.get("value") if tag else None
+
+    def form_fields(self, html):
+        # form name and {element id: value} of all inputs and selects (text of the selected option) of the page
+        soup = self.soup(html)
+        fields = {tag.get("id"): tag.get("value") for tag in soup.find_all("input", id=True)}
+        for tag in soup.find_all("select", id=True):
+            option = tag.find("option", selected=True)
+            fields[tag.get("id")] = option.string if option else None
+        return soup.form.get("name") if soup.form else None, fields
+
+    def device_rows(self, html):
+        # (id, mac address, name, model) of the device list
+        rows = []
+        for tag in self.soup(html).select("#dataTable-ip tbody tr"):
+            cells = [td.string for td in tag.find_all("td")]
+            rows.append((tag.get("id"), cells[2], cells[1], cells[3] if len(cells) > 3 else None))
+        return rows
+
+class LxmlParser(SoupParser):
+    # same extractors with libxml2 and xpath, several times faster than html.parser on the portal pages
+    name = "lxml"
+
+    def __init__(self):
+        import lxml.html
+        self.fromstring = lxml.html.fromstring
+
+    def tree(self, html):
+        return self.fromstring(html)
+
+    def title(self, html):
+        return self.tree(html).findtext(".//title")
+
+    def form_name(self, html):
+        names = self.tree(html).xpath("(//form)[1]/@name")
+        return names[0] if names else None
+
+    def input_value(self, html, id=None, name=None):
+        if id:
+            values = self.tree(html).xpath("//input[@id=$v]/@value", v=id)
+        else:
+            values = self.tree(html).xpath("//input[@name=$v]/@value", v=name)
+        return values[0] if values else None
+
+    def form_fields(self, html):
+        tree = self.tree(html)
+        fields = {tag.get("id"): tag.get("value") for tag in tree.xpath("//input[@id]")}
+        for tag in tree.xpath("//select[@id]"):
+            options = tag.xpath(".//option[@selected]")
+            fields[tag.get("id")] = options[0].text if options else None
+        names = tree.xpath("(//form)[1]/@name")
+        return names[0] if names else None, fields
+
+    def device_rows(self, html):
+        rows = []
+        for tag in self.tree(html).xpath('//*[@id="dataTable-ip"]//tbody//tr'):
+            cells = [td.text for td in tag.xpath("td")]
+            rows.append((tag.get("id"), cells[2], cells[1], cells[3] if len(cells) > 3 else None))
+        return rows
+
+PARSERS = {"html.parser": SoupParser, "lxml": LxmlParser}
+
+def html_parser(name="auto"):
+    try:
+        return PARSERS["lxml" if name == "auto" else name]()
+    except ImportError:  # lxml is an optional fast parser backend
+        if name == "lxml":
+            raise RuntimeError("the lxml parser backend requires the lxml package")
+        return SoupParser()
+
+class InventoryCache:
+    # parsed numbers and devices per account as JSON lines: a header line with the creation time followed by one
+    # record per line. Mutations append patched records (or {"id": .., "deleted": true}), the last line per id wins.
+    def __init__(self, directory, account, ttl, refresh=False):
+        self.directory = directory
+        self.account = account
+        self.ttl = ttl
+        self.refresh = refresh
+        self.lock = threading.Lock()
+
+    def path(self, kind):
+        return os.path.join(self.directory, "{}-{}.jsonl".format(self.account, kind))
+
+    def load(self, kind):
+        if self.refresh:
+            return None
+        try:
+            with open(self.path(kind), 'r') as f:
+                header = json.loads(f.readline())
+                if time.time() - header["created"] > self.ttl:
+                    logging.info("cached {} of account {} expired".format(kind, self.account))
+                    return None
+                records = {}
+                for line in f:
+                    record = json.loads(line)
+                    if record.get("deleted"):
+                        records.pop(record["id"], None)
+                    else:
+                        records[record["id"]] = record
+        except (IOError, ValueError, KeyError):
+            return None
+        logging.info("using {} cached {} from {}".format(len(records), kind, os.path.realpath(self.path(kind))))
+        return list(records.values())
+
+    def save(self, kind, records):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock, open(self.path(kind), 'w') as f:
+            logging.debug("caching {} {} into {}".format(len(records), kind, os.path.realpath(f.name)))
+            f.write(json.dumps({"account": self.account, "created": time.time()}) + "\n")
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def patch(self, kind, record):
+        with self.lock:
+            if not os.path.exists(self.path(kind)):
+                return
+            with open(self.path(kind), 'a') as f:
+                f.write(json.dumps(record) + "\n")
+
+    def remove(self, kind, id):
+        self.patch(kind, {"id": id, "deleted": True})
+
+    def invalidate(self, kind):
+        with self.lock:
+            try:
+                os.remove(self.path(kind))
+            except FileNotFoundError:
+                pass
+
+class Fingerprints:
+    # fingerprints of the spreadsheet row and portal listing entries of every device that passed the last
+    # verification, a device is only verified again when one of them changed or its check got older than max_age
+    def __init__(self, directory, account, max_age, refresh=False):
+        self.path = os.path.join(directory, "{}-verified.json".format(account))
+        self.max_age = max_age
+        self.entries = {}
+        if not refresh:
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                pass
+
+    @staticmethod
+    def of(*records):
+        return hashlib.sha256(json.dumps(records, sort_keys=True, default=str).encode()).hexdigest()
+
+    def stale(self, key, fingerprint):
+        entry = self.entries.get(str(key))
+        return entry is None or entry["fingerprint"] != fingerprint or time.time() - entry["verified"] > self.max_age
+
+    def put(self, key, fingerprint):
+        self.entries[str(key)] = {"fingerprint": fingerprint, "verified": time.time()}
+
+    def drop(self, key):
+        self.entries.pop(str(key), None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.entries, f)
+
+class SessionStore:
+    # the cookies of a logged in session per account and user, readable by the current user only
+    def __init__(self, directory, account, user):
+        self.directory = os.path.expanduser(directory)
+        self.path = os.path.join(self.directory, "{}-{}.json".format(account, hashlib.sha256(user.encode()).hexdigest()[:16]))
+
+    def restore(self, session):
+        try:
+            with open(self.path, 'r') as f:
+                cookies = json.load(f)
+        except (IOError, ValueError):
+            return False
+        for c in cookies:
+            session.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"], expires=c["expires"], secure=c["secure"])
+        logging.debug("restored session from {}".format(self.path))
+        return bool(cookies)
+
+    def save(self, session):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        cookies = [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires, "secure": c.secure} for c in session.cookies]
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cookies, f)
+
+    def forget(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class Journal:
+    # append-only log of the planned and completed actions of a bulk job as JSON lines, so an interrupted run can be
+    # resumed without repeating the work that already went through
+    def __init__(self, directory, account, job, resume=False, enabled=True):
+        self.path = os.path.join(directory, "{}-{}.journal".format(account, job))
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.planned = []  # (action, key) planned by the resumed run in order
+        if resume:
+            try:
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        if entry["state"] == "done":
+                            self.completed.add((entry["action"], entry["key"]))
+                        elif entry["state"] == "planned":
+                            self.planned.append((entry["action"], entry["key"]))
+                logging.info("resuming {}: {} actions already done".format(job, len(self.completed)))
+            except (IOError, ValueError):
+                logging.info("no journal of a previous {} run found".format(job))
+        elif enabled and os.path.exists(self.path):
+            os.remove(self.path)  # a new run starts a new journal
+
+    def done(self, action, key):
+        return (action, str(key)) in self.completed
+
+    def write(self, state, action, key):
+        if not self.enabled:
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({"time": time.time(), "state": state, "action": action, "key": str(key)}) + "\n")
+            if state == "done":
+                self.completed.add((action, str(key)))
+
+    def run(self, action, key, fn, *args):
+        if self.done(action, key):
+            logging.info("skip {} {}: already done in a previous run".format(action, key))
+            return
+        result = fn(*args)
+        self.write("done", action, key)
+        return result
+
+class CsrfTokens:
+    # the portal issues one CSRF token per form name and session, so a token is reused for every entity until the
+    # portal rejects it - then it is fetched again and the request is retried once
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def put(self, form, token):
+        with self.lock:
+            self.tokens[form] = token
+
+    def get(self, form, fetch):
+        with self.lock:
+            token = self.tokens.get(form)
+        if token is None:
+            token = fetch()
+            expect(token is not None, "no CSRF token found for {}", form)
+            logging.debug("found CSRF token {} for {}".format(token, form))
+            self.put(form, token)
+        return token
+
+    def submit(self, form, fetch, post):
+        token = self.get(form, fetch)
+        response = post(token)
+        if not self.rejected(form, response):
+            return response
+
+        logging.info("CSRF token for {} rejected, fetching a new one".format(form))
+        with self.lock:
+            if self.tokens.get(form) == token:
+                del self.tokens[form]
+        return post(self.get(form, fetch))
+
+    def clear(self):
+        with self.lock:
+            self.tokens.clear()
+
+    @staticmethod
+    def rejected(form, response):
+        # an invalid token renders the form again instead of the short json answer
+        return response.status_code in (400, 403, 419) or "{}[_token]".format(form) in response.text
+
+class RateLimiter:
+    # token bucket: allows bursts of up to `burst` requests and refills with `rate` tokens per second
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return  # unlimited
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class Metrics:
+    # per endpoint request counts, bytes, latency histogram and retries plus the time spent parsing the answers
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.parsing = {}
+        self.started = time.monotonic()
+
+    @staticmethod
+    def endpoint(method, url):
+        # /system/number/4711/activate -> POST /system/number/{id}/activate
+        return "{} {}".format(method.upper(), re.sub(r"/\d+(?=/|$)", "/{id}", urlsplit(url).path))
+
+    @staticmethod
+    def entry():
+        return {"requests": 0, "errors": 0, "retries": 0, "bytes": 0, "seconds": 0.0, "buckets": [0] * len(Metrics.BUCKETS)}
+
+    def request(self, method, url, seconds, size, error=None):
+        with self.lock:
+            e = self.endpoints.setdefault(Metrics.endpoint(method, url), Metrics.entry())
+            e["requests"] += 1
+            e["errors"] += 1 if error else 0
+            e["bytes"] += size
+            e["seconds"] += seconds
+            e["buckets"][next(i for i, le in enumerate(Metrics.BUCKETS) if seconds <= le)] += 1
+
+    def retry(self, method, url):
+        with self.lock:
+            self.endpoints[Metrics.endpoint(method, url)]["retries"] += 1
+
+    def merge(self, other):
+        # adds the metrics of another run, e.g. of one account in multi account mode
+        with other.lock:
+            endpoints = json.loads(json.dumps(other.endpoints))
+            parsing = json.loads(json.dumps(other.parsing))
+        with self.lock:
+            for name, e in endpoints.items():
+                mine = self.endpoints.setdefault(name, Metrics.entry())
+                for key in ("requests", "errors", "retries", "bytes", "seconds"):
+                    mine[key] += e[key]
+                mine["buckets"] = [a + b for a, b in zip(mine["buckets"], e["buckets"])]
+            for name, p in parsing.items():
+                mine = self.parsing.setdefault(name, {"calls": 0, "seconds": 0.0})
+                mine["calls"] += p["calls"]
+                mine["seconds"] += p["seconds"]
+
+    @contextmanager
+    def parse(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                p = self.parsing.setdefault(name, {"calls": 0, "seconds": 0.0})
+                p["calls"] += 1
+                p["seconds"] += time.perf_counter() - started
+
+    @staticmethod
+    def quantile(e, q):
+        # upper bound of the histogram bucket holding the q quantile
+        rank, seen = q * e["requests"], 0
+        for le, count in zip(Metrics.BUCKETS, e["buckets"]):
+            seen += count
+            if seen >= rank:
+                return le
+        return float("inf")
+
+    def summary(self):
+        lines = ["{:<48} {:>8} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9}".format("endpoint", "requests", "errors", "retries", "kbytes", "avg ms", "p50 <=", "p95 <=")]
+        with self.lock:
+            for name, e in sorted(self.endpoints.items(), key=lambda item: -item[1]["seconds"]):
+                lines.append("{:<48} {:>8} {:>7} {:>7} {:>10.1f} {:>9.1f} {:>9} {:>9}".format(
+                    name, e["requests"], e["errors"], e["retries"], e["bytes"] / 1024.0, e["seconds"] / e["requests"] * 1000,
+                    "{:g}s".format(Metrics.quantile(e, 0.5)), "{:g}s".format(Metrics.quantile(e, 0.95))))
+            network = sum(e["seconds"] for e in self.endpoints.values())
+            parsing = sum(p["seconds"] for p in self.parsing.values())
+            requests_total = sum(e["requests"] for e in self.endpoints.values())
+        elapsed = time.monotonic() - self.started
+        lines.append("{} requests in {:.1f}s ({:.1f}/s), network {:.1f}s, parsing {:.1f}s".format(
+            requests_total, elapsed, requests_total / elapsed if elapsed else 0, network, parsing))
+        return "\n".join(lines)
+
+    def json(self):
+        with self.lock:
+            return json.dumps({"elapsed": time.monotonic() - self.started, "buckets": [str(le) for le in Metrics.BUCKETS],
+                               "endpoints": self.endpoints, "parsing": self.parsing}, indent=2)
+
+    def prometheus(self):
+        # textfile collector format
+        lines = []
+        with self.lock:
+            for name, e in sorted(self.endpoints.items()):
+                method, path = name.split(" ", 1)
+                labels = 'method="{}",endpoint="{}"'.format(method, path)
+                lines.append('fonial_requests_total{{{}}} {}'.format(labels, e["requests"]))
+                lines.append('fonial_request_errors_total{{{}}} {}'.format(labels, e["errors"]))
+                lines.append('fonial_request_retries_total{{{}}} {}'.format(labels, e["retries"]))
+                lines.append('fonial_response_bytes_total{{{}}} {}'.format(labels, e["bytes"]))
+                cumulative = 0
+                for le, count in zip(Metrics.BUCKETS, e["buckets"]):
+                    cumulative += count
+                    lines.append('fonial_request_seconds_bucket{{{},le="{}"}} {}'.format(labels, "+Inf" if le == float("inf") else le, cumulative))
+                lines.append('fonial_request_seconds_sum{{{}}} {}'.format(labels, e["seconds"]))
+                lines.append('fonial_request_seconds_count{{{}}} {}'.format(labels, e["requests"]))
+            for name, p in sorted(self.parsing.items()):
+                lines.append('fonial_parse_seconds_sum{{extractor="{}"}} {}'.format(name, p["seconds"]))
+                lines.append('fonial_parse_seconds_count{{extractor="{}"}} {}'.format(name, p["calls"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.json() if path.endswith(".json") else self.prometheus())
+
+class TimedParser:
+    # forwards to a parser backend and records the time spent in every extractor
+    def __init__(self, parser, metrics):
+        self.parser = parser
+        self.metrics = metrics
+        self.name = parser.name
+
+    def __getattr__(self, name):
+        fn = getattr(self.parser, name)
+
+        def timed(*args, **kwargs):
+            with self.metrics.parse(name):
+                return fn(*args, **kwargs)
+        return timed
+
+class CircuitBreaker:
+    # opens after `threshold` failed requests in a row and pauses every worker for `cooldown` seconds
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            remaining = self.opened_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.failures = 0
+                self.opened_until = time.monotonic() + self.cooldown
+                logging.warning("fonial portal degraded, pausing all requests for {} seconds".format(self.cooldown))
+
+# answers worth another try and timeouts of the slow listing endpoints (the default applies to all others)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# a POST may have been processed even when its answer is an error, it is only retried when the portal surely dropped it
+UNPROCESSED_STATUS = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+ENDPOINT_TIMEOUTS = {"/system/number/json": 120, "/system/device/": 120}
+
+class FonialSession(object):
+    # a requests session with rate limit, retries, circuit breaker and login on demand; everything else (cookies,
+    # hooks, ...) is forwarded to the wrapped session. It is thread safe: the bulk commands fan out over one session
+    # with a ThreadPoolExecutor of --workers threads instead of an asyncio client
+    def __init__(self, rate=None, pool_size=10, retries=4, timeout=30, backoff=0.5, metrics=None, limiter=None, gate=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.exceptions import NewConnectionError
+        self.http = requests.Session()
+        self.transient = (requests.ConnectionError, requests.Timeout)
+        self.not_connected = (requests.ConnectTimeout, NewConnectionError)
+        self.metrics = metrics or Metrics()
+        # limiter and gate are shared by the sessions of all accounts in multi account mode
+        self.limiter = limiter or RateLimiter(rate)
+        self.gate = gate or nullcontext()
+        self.breaker = CircuitBreaker()
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.connect = None  # logs in, called before the first request
+        self.connecting = False
+        self.connect_lock = threading.RLock()
+        self.relogin = None  # called when the portal answers with the login page
+        self.logins = 0
+        self.login_lock = threading.Lock()
+        # keep-alive connection pool to the portal sized for the parallel workers
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def open(self):
+        # the requests of connect itself pass through, other threads wait until it is done
+        with self.connect_lock:
+            if self.connect is not None and not self.connecting:
+                self.connecting = True
+                try:
+                    self.connect()
+                    self.connect = None
+                finally:
+                    self.connecting = False
+
+    def request(self, method, url, *args, **kwargs):
+        if self.connect is not None:
+            self.open()
+        path = url.split("?")[0]
+        kwargs.setdefault("timeout", next((t for suffix, t in ENDPOINT_TIMEOUTS.items() if path.endswith(suffix)), self.timeout))
+        logins = self.logins
+        attempt = relogins = 0
+        while True:
+            self.breaker.wait()
+            self.limiter.acquire()
+            with self.gate:
+                started = time.perf_counter()
+                try:
+                    response = self.http.request(method, url, *args, **kwargs)
+                    error = None if response.status_code not in RETRY_STATUS else "status {}".format(response.status_code)
+                except self.transient as e:
+                    response, error = None, e
+            self.metrics.request(method, url, time.perf_counter() - started, len(response.content) if response is not None else 0, error)
+
+            if error is None:
+                self.breaker.success()
+                if not (self.relogin and self.expired(path, response)):
+                    return response
+                if relogins == 3:
+                    raise FonialError("{} {} keeps returning the login page".format(method, path))
+                relogins += 1
+                self.login_again(logins)
+                logins = self.logins
+                continue
+
+            self.breaker.failure()
+            if method.upper() not in IDEMPOTENT_METHODS and not self.unprocessed(error, response):
+                raise FonialError("{} {} failed ({}), not retried since the portal may have processed it".format(method, path, error))
+            if attempt == self.retries:
+                raise FonialError("{} {} failed after {} attempts: {}".format(method, path, attempt + 1, error))
+            # exponential backoff with full jitter, or what the portal asks for
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if response is not None and response.headers.get("Retry-After", "").isdigit():
+                delay = int(response.headers["Retry-After"])
+            attempt += 1
+            self.metrics.retry(method, url)
+            logging.info("{} {} failed ({}), retrying in {:.1f}s".format(method, path, error, delay))
+            time.sleep(delay)
+
+    def unprocessed(self, error, response):
+        # the request surely did not reach the portal: no connection or an answer that it was not handled
+        if response is not None:
+            return response.status_code in UNPROCESSED_STATUS
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(error, self.not_connected) or isinstance(reason, self.not_connected)
+
+    @staticmethod
+    def expired(path, response):
+        return not path.endswith(("/login", "/login_check")) and response.url.split("?")[0].endswith("/login")
+
+    def login_again(self, logins):
+        with self.login_lock:
+            if self.logins == logins:  # another worker did not log in meanwhile
+                logging.info("session expired, logging in again")
+                self.relogin()
+                self.logins += 1
+
 class Fonial(object):
-    def __init__(self, args) -> None:
+    def __init__(self, args, limiter=None, gate=None) -> None:
         self.args = args
         logging.basicConfig(level=logging.DEBUG if self.args.debug else logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.session = requests.session()
-        self.login(self.args.user, self.args.password)
-
+        self.base_url = self.args.base_url.rstrip("/")
+        self.metrics = Metrics()
+        self.session = FonialSession(rate=self.args.rate, pool_size=self.args.workers, retries=self.args.retries, timeout=self.args.timeout,
+                                    metrics=self.metrics, limiter=limiter, gate=gate)
+        self.parser = TimedParser(html_parser(self.args.parser), self.metrics)
+        self.tokens = CsrfTokens()
+        self.inventory = Inventory()
+        self.cache = InventoryCache(self.args.cache_dir, self.args.account, self.args.cache_ttl, self.args.refresh)
+        self.sessions = SessionStore(self.args.session_dir, self.args.account, self.args.user)
+        self.failed = []  # actions of this run that failed, the process exits with 1 if there are any
+        self.session.connect = self.connect  # commands answered from the cache never log in
+
+    def connect(self):
+        if not (self.sessions.restore(self.session) and self.logged_in()):
+            self.login(self.args.user, self.password())
+        self.session.relogin = self.relogin
+
+    def report(self):
+        print(self.metrics.summary())
+        if self.args.metrics:
+            self.metrics.write(self.args.metrics)
+            logging.info("metrics written to {}".format(self.args.metrics))
+
+    def password(self):
+        # only ask when a login is actually needed
+        if not self.args.password:
+            self.args.password = getpass("password for {}".format(self.args.user))
+        return self.args.password
+
+    def logged_in(self):
+        response = self.session.get(self.url("/"))
+        if response.status_code != 200 or FonialSession.expired("/", response):
+            logging.info("stored session expired")
+            self.session.cookies.clear()
+            return False
+        logging.debug("reusing stored session")
+        return True
+
+    def relogin(self):
+        self.tokens.clear()  # the tokens belong to the expired session
+        self.login(self.args.user, self.password())
 
     def login(self, username, password):
-        response = self.session.get("https://kundenkonto.fonial.de/login")
-        soup = BeautifulSoup(response.content, 'html.parser')
-        assert soup.title.string == "Login"
-        csrf = soup.find("input", {"name": "_csrf_token"}).get("value")
+        response = self.session.get(self.url("/login"))
+        expect(self.parser.title(response.content) == "Login", "login page not found")
+        csrf = self.parser.input_value(response.content, name="_csrf_token")
 
-        response = self.session.post("https://kundenkonto.fonial.de/login_check", data={
+        response = self.session.post(self.url("/login_check"), data={
             "_csrf_token": csrf,
             "_username":  username,
             "_password": password
         })
-        soup = BeautifulSoup(response.content, 'html.parser')
-        assert soup.title.string == "fonial Kundenkonto"
-        logging.debug("successfully logged in as #{username}")
+        expect(self.parser.title(response.content) == "fonial Kundenkonto", "login as {} failed", username)
+        logging.debug("successfully logged in as {}".format(username))
+        self.sessions.save(self.session)
+
+    def journal(self, job):
+        return Journal(self.args.cache_dir, self.args.account, job, self.args.resume, enabled=not self.args.dry_run)
+
+    def url(self, path):
+        return self.base_url + path
+
+    def debug_page(self, response):
+        # pretty printing a whole page is expensive, only do it when it is going to be logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            from bs4 import BeautifulSoup
+            logging.debug(BeautifulSoup(response.content, 'html.parser').prettify())
 
     ## DEVICES
 
     def loadDevices(self):
-        try:
-            with open('devices.response', 'r') as f:
-                logging.info("using cached devices from {}".format(os.path.realpath(f.name)))
-                soup = BeautifulSoup(f.read(), 'html.parser')
-        except IOError:
+        records = self.cache.load("devices")
+        if records is None:
             logging.info("reload devices from fonial")
-            response = self.session.post("https://kundenkonto.fonial.de/system/device/")
-            soup = BeautifulSoup(response.content, 'html.parser')
-            logging.debug(soup.prettify())
-            with open('devices.response', 'w') as f:
-                logging.debug("caching devices into {}".format(os.path.realpath(f.name)))
-                f.write(response.text)
-
-        devices = {}
-        for tag in soup.select("#dataTable-ip tbody tr"):
-            device = FonialDevice(tag.get("id"), tag.find_all("td")[2].string)
-            devices[device.mac_address] = device
-        logging.debug("found devices {}".format(devices))
-        return devices
+            response = self.session.post(self.url("/system/device/"))
+            self.debug_page(response)
+            records = [FonialDevice(*row).record() for row in self.parser.device_rows(response.content)]
+            self.cache.save("devices", records)
+
+        self.inventory.clear_devices()
+        for record in records:
+            self.inventory.add_device(FonialDevice(**record))
+        logging.debug("found {} devices".format(len(self.inventory.devices)))
+        return self.inventory.by_mac
+
+    def read_new_devices(self):
+        # the pre-flight check already rejected sheets with rows without number or mac address
+        for row in read_sheet(self.args.file):
+            yield as_text(row["name"]), as_text(row["mac_address"]), as_text(row["number"])
 
     def new_devices(self):
-        with open(self.args.file, 'r', encoding='utf-8-sig', newline='') as src:
-            reader = csv.reader(src, delimiter=';', quotechar='"')
-            next(reader)  # skip header row
+        journal = self.journal("new_devices")
+        numbers = self.preflight(required=("number", "mac_address"))
+        self.loadDevices()
+
+        # stage one: validate every row against the indexes before the first change
+        sheet = list(self.read_new_devices())
+        rows, results, seen_macs, seen_numbers = [], {}, set(), set()
+        for i, (name, mac_address, number) in enumerate(sheet):
+            mac = normalize_mac(mac_address)
+            n = numbers.get(number)
+            if journal.done("create", mac_address):
+                results[i] = "already created in a previous run"
+            elif mac in seen_macs:
+                results[i] = "duplicate mac address in sheet"
+            elif self.inventory.device_by_mac(mac) is not None:
+                results[i] = "mac address already exists in fonial account"
+            elif n is None:
+                results[i] = "phone number {} not found in fonial account".format(number)
+            elif number in seen_numbers:
+                results[i] = "phone number {} used twice in sheet".format(number)
+            elif n.cancelled:
+                results[i] = "phone number {} is cancelled".format(number)
+            else:
+                rows.append((i, name, mac_address, n))
+            seen_macs.add(mac)
+            seen_numbers.add(number)
+        inactive = list({n.number: n for i, name, mac_address, n in rows if not n.state}.values())
+        logging.info("{} devices to create, {} numbers to activate, {} rows rejected".format(len(rows), len(inactive), len(results)))
 
-            numbers = self.loadNumbers()
-            csrf = None
-
-            for row in reader:
-                print("creating {}".format(row))
-
-                if not row[1]:
-                    print("skip because no phone number found in CSV")
-                    continue
-
-                if not row[3]:
-                    print("skip because no Mac Address found in CSV")
-                    continue
-
-                if not row[1] in numbers:
-                    print("skip because phone number {} not found in fonial account".format(row[1]))
-                    continue
-                n = numbers[row[1]]
-
-                csrf = self.new_device(row[0], row[3], n, csrf)
-
-                # if not n.state:
-                #     self.activateNumber(n)
-                #
-                # response = self.session.get("https://kundenkonto.fonial.de/system/device/ipdevice/new")
-                # soup = BeautifulSoup(response.content, 'html.parser')
-                # logging.debug(soup.prettify())
-                # assert soup.form.get("name") == "fonial_frontend_device_ip_device"
-                #
-                # csrf = soup.find("input", id="fonial_frontend_device_ip_device__token").get("value")
-                # assert csrf is not None
-                # logging.info("found CSRF token {}".format(csrf))
-                #
-                # response = self.session.post("https://kundenkonto.fonial.de/system/device/create", data={
-                #     "fonial_frontend_device_ip_device[model]": "13",            # Snom D715
-                #     "fonial_frontend_device_ip_device[targetName]": row[0],     # <Name>
-                #     "fonial_frontend_device_ip_device[mac]": row[3],            # <Mac-Address>
-                #     "fonial_frontend_device_ip_device[provisioning_template]": "",
-                #     "fonial_frontend_device_ip_device[keyextensions]": "",
-                #     "fonial_frontend_device_ip_device[outboundnum]": n.id,      # the ID of the fonial phone number
-                #     "fonial_frontend_device_ip_device[moh]": "4",
-                #     "fonial_frontend_device_ip_device[internalext]": int(row[2]),   # the 3-digit extension 678
-                #     "fonial_frontend_device_ip_device[automatic]": "1",
-                #     "fonial_frontend_device_ip_device[hash]": "ip",
-                #     "fonial_frontend_device_ip_device[targetType]": "IPDEVICE",
-                #     "fonial_frontend_device_ip_device[account]": self.args.account,  # <fonial account id>,
-                #     "fonial_frontend_device_ip_device[targetOtherPhone]": "",
-                #     "fonial_frontend_device_ip_device[targetOtherModel]": "13",
-                #     "fonial_frontend_device_ip_device[_token]": csrf            # the CSRF token
-                # })
-                # logging.debug(response.text)
-                # assert response.status_code == 200
-                # assert response.text == '["\\/system\\/device\\/#ip"]'
-
-    def new_device(self, name, mac_address, number, csrf=None):
+        if self.args.dry_run:
+            for i, name, mac_address, n in rows:
+                results[i] = "would be created with number {}".format(n.number)
+        else:
+            for i, name, mac_address, n in rows:
+                journal.write("planned", "create", mac_address)
+
+            # stage two: activate all numbers in one parallel batch
+            failed = {}
+            for n, error in zip(inactive, self.run_batch(self.activateNumber, [(n,) for n in inactive])):
+                if error:
+                    failed[n.number] = "activating {} failed: {}".format(n.number, error)
+            self.failed += failed.values()
+            for i, name, mac_address, n in rows:
+                if n.number in failed:
+                    results[i] = failed[n.number]
+            rows = [row for row in rows if row[3].number not in failed]
+
+            # stage three: create the devices with bounded parallelism
+            create = lambda i, name, mac_address, n: journal.run("create", mac_address, self.new_device, name, mac_address, n)
+            for (i, name, mac_address, n), error in zip(rows, self.run_batch(create, rows)):
+                results[i] = "failed: {}".format(error) if error else "created with number {}".format(n.number)
+                if error:
+                    self.failed.append("creating {} failed: {}".format(mac_address, error))
+
+        for i, (name, mac_address, number) in enumerate(sheet):
+            print("{} {} {}: {}".format(name, mac_address, number, results[i]))
+        return results
+
+    def run_batch(self, fn, items):
+        # runs fn for every argument tuple in the worker pool and returns the error of each call or None
+        def call(args):
+            try:
+                fn(*args)
+            except FonialError as e:
+                logging.warning("{}".format(e))
+                return str(e) or type(e).__name__
+
+        with ThreadPoolExecutor(max_workers=self.args.workers) as pool:
+            return list(pool.map(call, items))
+
+    def new_device(self, name, mac_address, number):
         if not number.state:
             self.activateNumber(number)
 
-        if not csrf:
-            response = self.session.get("https://kundenkonto.fonial.de/system/device/ipdevice/new")
-            soup = BeautifulSoup(response.content, 'html.parser')
-            logging.debug(soup.prettify())
-            assert soup.form.get("name") == "fonial_frontend_device_ip_device"
-
-            csrf = soup.find("input", id="fonial_frontend_device_ip_device__token").get("value")
-            assert csrf is not None
-            logging.debug("found CSRF token {}".format(csrf))
-
-        response = self.session.post("https://kundenkonto.fonial.de/system/device/create", data={
-            "fonial_frontend_device_ip_device[model]": "13",  # Snom D715
-            "fonial_frontend_device_ip_device[targetName]": name,  # <Name>
-            "fonial_frontend_device_ip_device[mac]": mac_address,  # <Mac-Address>
-            "fonial_frontend_device_ip_device[provisioning_template]": "",
-            "fonial_frontend_device_ip_device[keyextensions]": "",
-            "fonial_frontend_device_ip_device[outboundnum]": number.id,  # the ID of the fonial phone number
-            "fonial_frontend_device_ip_device[moh]": "4",
-            "fonial_frontend_device_ip_device[internalext]": number.extension,  # the 3-digit extension - e.g. 678
-            "fonial_frontend_device_ip_device[automatic]": "1",
-            "fonial_frontend_device_ip_device[hash]": "ip",
-            "fonial_frontend_device_ip_device[targetType]": "IPDEVICE",
-            "fonial_frontend_device_ip_device[account]": self.args.account,  # <fonial account id>,
-            "fonial_frontend_device_ip_device[targetOtherPhone]": "",
-            "fonial_frontend_device_ip_device[targetOtherModel]": "13",
-            "fonial_frontend_device_ip_device[_token]": csrf  # the CSRF token
-        })
+        response = self.tokens.submit("fonial_frontend_device_ip_device", self.fetch_device_token, lambda csrf: self.session.post(
+            self.url("/system/device/create"), data={
+                "fonial_frontend_device_ip_device[model]": "13",  # Snom D715
+                "fonial_frontend_device_ip_device[targetName]": name,  # <Name>
+                "fonial_frontend_device_ip_device[mac]": mac_address,  # <Mac-Address>
+                "fonial_frontend_device_ip_device[provisioning_template]": "",
+                "fonial_frontend_device_ip_device[keyextensions]": "",
+                "fonial_frontend_device_ip_device[outboundnum]": number.id,  # the ID of the fonial phone number
+                "fonial_frontend_device_ip_device[moh]": "4",
+                "fonial_frontend_device_ip_device[internalext]": number.extension,  # the 3-digit extension - e.g. 678
+                "fonial_frontend_device_ip_device[automatic]": "1",
+                "fonial_frontend_device_ip_device[hash]": "ip",
+                "fonial_frontend_device_ip_device[targetType]": "IPDEVICE",
+                "fonial_frontend_device_ip_device[account]": self.args.account,  # <fonial account id>,
+                "fonial_frontend_device_ip_device[targetOtherPhone]": "",
+                "fonial_frontend_device_ip_device[targetOtherModel]": "13",
+                "fonial_frontend_device_ip_device[_token]": csrf  # the CSRF token
+            }))
         logging.debug(response.text)
-        assert response.status_code == 200
-        assert response.text == '["\\/system\\/device\\/#ip"]'
+        expect(response.status_code == 200 and response.text == '["\\/system\\/device\\/#ip"]', "creating device {} failed: {}", mac_address, response.text[:200])
+        # the id of the new device is not known before reloading the device list, and the number now targets it
+        self.cache.invalidate("devices")
+        self.cache.invalidate("numbers")
 
-        return csrf
+    def fetch_device_token(self):
+        response = self.session.get(self.url("/system/device/ipdevice/new"))
+        self.debug_page(response)
+        expect(self.parser.form_name(response.content) == "fonial_frontend_device_ip_device", "new device form not found")
+        return self.parser.input_value(response.content, id="fonial_frontend_device_ip_device__token")
 
     def update_device(self, device, user):
-        response = self.session.get("https://kundenkonto.fonial.de/system/device/70784/ipdevice/edit")
-        soup = BeautifulSoup(response.content, 'html.parser')
-        logging.debug(soup.prettify())
-        assert soup.form.get("name") == "fonial_frontend_device_ip_device"
+        response = self.session.get(self.url("/system/device/70784/ipdevice/edit"))
+        self.debug_page(response)
+        expect(self.parser.form_name(response.content) == "fonial_frontend_device_ip_device", "device form not found")
 
     def delete_device(self, d: FonialDevice):
         logging.info("deleting device {}".format(d))
-        response = self.session.post("https://kundenkonto.fonial.de/system/device/{}/delete".format(d.id))
-
-    def bind_number_to_device(self, name, device: FonialDevice, number: FonialNumber, csrf=None):
+        response = self.session.post(self.url("/system/device/{}/delete".format(d.id)))
+        expect(answered(response), "deleting device {} failed: {}", d, response.text[:200])
+        n = self.inventory.remove_device(d)
+        self.cache.remove("devices", d.id)
+        if n is not None:
+            self.cache.patch("numbers", n.record())
+
+    def bind_number_to_device(self, name, device: FonialDevice, number: FonialNumber):
         if not number.state:
-            logging.info("{}: outbound number {} inactive".format(device.name, number.number))
+            logging.info("{}: outbound number {} inactive".format(name, number.number))
             return
 
         logging.info("{}: fixing outbound number".format(device.id, number))
         if self.args.dry_run:
             return
 
-        if not csrf:
-            response = self.session.get("https://kundenkonto.fonial.de/system/device/{}/ipdevice/edit".format(device.id))
-            soup = BeautifulSoup(response.content, 'html.parser')
-            assert soup.form.get("name") == "fonial_frontend_device_ip_device"
-            csrf = soup.find("input", id="fonial_frontend_device_ip_device__token").get("value")
-            assert csrf is not None
-            logging.debug("found CSRF token {}".format(csrf))
-
-        response = self.session.post(
-            "https://kundenkonto.fonial.de/system/device/{}/update".format(device.id), data={
+        response = self.tokens.submit("fonial_frontend_device_ip_device", self.fetch_device_token, lambda csrf: self.session.post(
+            self.url("/system/device/{}/update".format(device.id)), data={
                 "fonial_frontend_device_ip_device[targetName]": name,  # <Name>
                 "fonial_frontend_device_ip_device[mac]": device.mac_address,  # <Mac-Address>
                 "fonial_frontend_device_ip_device[provisioning_template]": "",
@@ -228,14 +1098,64 @@ class Fonial(object):
                 "fonial_frontend_device_ip_device[targetOtherPhone]": "",
                 "fonial_frontend_device_ip_device[targetOtherModel]": "13",
                 "fonial_frontend_device_ip_device[_token]": csrf  # the CSRF token
-            })
-
+            }))
+        logging.debug(response.text)
+        expect(answered(response) and not CsrfTokens.rejected("fonial_frontend_device_ip_device", response),
+               "updating outbound number of device {} to {} failed: {}", device.id, number.number, response.text[:200])
 
     ## NUMBERS
 
     def loadNumbers(self):
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/json", data={
-            "draw": "1",
+        for n in self.iterNumbers():
+            pass
+        logging.debug("found {} numbers".format(len(self.inventory.numbers)))
+        return self.inventory.by_number
+
+    def iterNumbers(self, page_size=500, prefetch=True):
+        # yields the numbers while indexing them into the inventory
+        self.inventory.clear_numbers()
+        records = self.cache.load("numbers")
+        if records is not None:
+            for record in records:
+                n = FonialNumber(**record)
+                self.inventory.add_number(n)
+                yield n
+            return
+
+        records = []
+        seen = set()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            start, draw = 0, 1
+            page = pool.submit(self.loadNumbersPage, start, page_size, draw)
+            while page is not None:
+                j = page.result()
+                total = int(j["recordsTotal"])
+                logging.debug("received numbers {}-{} of {}".format(start, start + len(j["data"]), total))
+                # the portal may answer with fewer rows than asked for, continue after the rows actually received
+                start, draw = start + len(j["data"]), draw + 1
+                more = start < total and len(j["data"]) > 0
+
+                # fetch the next page while the caller is busy with the current one
+                page = pool.submit(self.loadNumbersPage, start, page_size, draw) if more and prefetch else None
+
+                for no in j["data"]:
+                    n = FonialNumber(str(no["DT_RowId"]), str(no["number"][4:]), no["type"], no["state"], bool(no["cancel_at"]), bool(len(no["targets"])),
+                                     [str(t["id"]) if isinstance(t, dict) else str(t) for t in no["targets"]])
+                    if n.id in seen:
+                        continue  # shifted into the next page while paging
+                    seen.add(n.id)
+                    records.append(n.record())
+                    self.inventory.add_number(n)
+                    yield n
+
+                if more and not prefetch:
+                    page = pool.submit(self.loadNumbersPage, start, page_size, draw)
+
+        self.cache.save("numbers", records)
+
+    def loadNumbersPage(self, start, length, draw=1):
+        response = self.session.post(self.url("/system/number/json"), data={
+            "draw": str(draw),
             "columns[0][data]": "number",
             "columns[0][name]": "",
             "columns[0][searchable]": "true",
@@ -275,19 +1195,15 @@ class Fonial(object):
             "columns[5][search][regex]": "false",
             "order[0][column]": "4",
             "order[0][dir]": "desc",
-            "start": "0",
-            "length": "2000",
+            "order[1][column]": "0",  # tie breaker so pages do not overlap
+            "order[1][dir]": "asc",
+            "start": str(start),
+            "length": str(length),
             "search[value]": "",
             "search[regex]": "false"
         })
-
-        numbers = {}
-        j = json.loads(response.content)
-        for no in j["data"]:
-            n = FonialNumber(str(no["DT_RowId"]), str(no["number"][4:]), no["type"], no["state"], bool(no["cancel_at"]), bool(len(no["targets"])))
-            numbers[n.number] = n
-        logging.debug("found {} numbers: {}".format(len(numbers), numbers.keys()))
-        return numbers
+        with self.metrics.parse("json"):
+            return json.loads(response.content)
 
     def activateNumber(self, n):
         if n.state:
@@ -298,19 +1214,15 @@ class Fonial(object):
         if self.args.dry_run:
             return
 
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/activate".format(n.id))
-        soup = BeautifulSoup(response.content, 'html.parser')
-        logging.debug(soup.prettify())
-        csrf = soup.find("input", {"id": "form__token"}).get("value")
-        assert csrf is not None
-        logging.info("found CSRF token {}".format(csrf))
-
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/update/activate".format(n.id), data={
-            "form[_token]": csrf
-        })
+        response = self.tokens.submit("form", lambda: self.fetch_number_token(n, "activate"), lambda csrf: self.session.post(
+            self.url("/system/number/{}/update/activate".format(n.id)), data={
+                "form[_token]": csrf
+            }))
         logging.debug(response.text)
-        # assert response.text == "\\/system\\/number\\/{}\\/update\\/activate\\/success".format(n.id)
+        expect(succeeded(response, "/system/number/{}/update/activate/success".format(n.id)), "activating {} failed: {}", n.number, response.text[:200])
         n.state = True # store the new active state w/o reloading the truth from server -> a little risk!
+        self.inventory.update_number(n)
+        self.cache.patch("numbers", n.record())
 
     def deactivateNumber(self, n):
         if not n.state:
@@ -325,19 +1237,21 @@ class Fonial(object):
         if self.args.dry_run:
             return
 
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/deactivate".format(n.id))
-        soup = BeautifulSoup(response.content, 'html.parser')
-        logging.debug(soup.prettify())
-        csrf = soup.find("input", {"id": "form__token"}).get("value")
-        assert csrf is not None
-        logging.debug("found CSRF token {}".format(csrf))
-
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/update/deactivate".format(n.id), data={
-            "form[_token]": csrf
-        })
+        response = self.tokens.submit("form", lambda: self.fetch_number_token(n, "deactivate"), lambda csrf: self.session.post(
+            self.url("/system/number/{}/update/deactivate".format(n.id)), data={
+                "form[_token]": csrf
+            }))
         logging.debug(response.text)
+        expect(succeeded(response, "/system/number/{}/update/deactivate/success".format(n.id)), "deactivating {} failed: {}", n.number, response.text[:200])
         n.state = False # store the new inactive state w/o reloading the truth from server -> a little risk!
         n.cancelled = False # store the new cancelled state w/o reloading the truth from server -> a little risk!
+        self.inventory.update_number(n)
+        self.cache.patch("numbers", n.record())
+
+    def fetch_number_token(self, n, action):
+        response = self.session.post(self.url("/system/number/{}/{}".format(n.id, action)))
+        self.debug_page(response)
+        return self.parser.input_value(response.content, id="form__token")
 
     def bind_device_to_number(self, n, d):
         if not n.state:
@@ -348,221 +1262,670 @@ class Fonial(object):
         if self.args.dry_run:
             return
 
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/edit/number".format(n.id))
-        soup = BeautifulSoup(response.content, 'html.parser')
-        csrf = soup.find("input", {"id": "fonial_databundle_number__token"}).get("value")
-        assert csrf is not None
-        logging.debug("found CSRF token {}".format(csrf))
-
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/update".format(n.id), {
-            "fonial_databundle_number[settings][0][name]": " Regel 1",
-            "fonial_databundle_number[settings][0][priority]": "0",
-            "fonial_databundle_number[settings][0][active]": "1",
-            "fonial_databundle_number[settings][0][redirectType]": "NORULE",
-            "fonial_databundle_number[settings][0][redirectDaysFrom]": "",
-            "fonial_databundle_number[settings][0][redirectDaysTo]": "",
-            "fonial_databundle_number[settings][0][filterNumbersData]": "",
-            "fonial_databundle_number[settings][0][forwardPromptData]": "",
-            "fonial_databundle_number[settings][0][forwardPinData]": "",
-            "fonial_databundle_number[settings][0][redirectSimultaneousPeriod]": "0",
-            "fonial_databundle_number[settings][0][targets][0][target]": d,
-            "fonial_databundle_number[settings][0][targets][0][delay]": "0",
-            "fonial_databundle_number[base_target]": "",
-            "fonial_databundle_number[type]": "VOICE",
-            "fonial_databundle_number[_token]": csrf
-        })
+        response = self.tokens.submit("fonial_databundle_number", lambda: self.fetch_number_edit_token(n), lambda csrf: self.session.post(
+            self.url("/system/number/{}/update".format(n.id)), {
+                "fonial_databundle_number[settings][0][name]": " Regel 1",
+                "fonial_databundle_number[settings][0][priority]": "0",
+                "fonial_databundle_number[settings][0][active]": "1",
+                "fonial_databundle_number[settings][0][redirectType]": "NORULE",
+                "fonial_databundle_number[settings][0][redirectDaysFrom]": "",
+                "fonial_databundle_number[settings][0][redirectDaysTo]": "",
+                "fonial_databundle_number[settings][0][filterNumbersData]": "",
+                "fonial_databundle_number[settings][0][forwardPromptData]": "",
+                "fonial_databundle_number[settings][0][forwardPinData]": "",
+                "fonial_databundle_number[settings][0][redirectSimultaneousPeriod]": "0",
+                "fonial_databundle_number[settings][0][targets][0][target]": d,
+                "fonial_databundle_number[settings][0][targets][0][delay]": "0",
+                "fonial_databundle_number[base_target]": "",
+                "fonial_databundle_number[type]": "VOICE",
+                "fonial_databundle_number[_token]": csrf
+            }))
         logging.debug(response.text)
+        expect(answered(response) and not CsrfTokens.rejected("fonial_databundle_number", response), "binding device {} to {} failed: {}", d, n.number, response.text[:200])
+        n.targets = [str(d)]
+        n.assigned = True
+        self.inventory.update_number(n)
+        self.cache.patch("numbers", n.record())
+
+    def fetch_number_edit_token(self, n):
+        response = self.session.post(self.url("/system/number/{}/edit/number".format(n.id)))
+        return self.parser.input_value(response.content, id="fonial_databundle_number__token")
 
-    def switch_number(self, source, destination, csrf=None):
+    def switch_number(self, source, destination):
         logging.info("switching {} to {}".format(source, destination))
-        assert source.state is True
-        assert destination.state is False
+        expect(source.state is True, "can not switch the inactive number {}", source)
+        expect(destination.state is False, "can not switch to the active number {}", destination)
 
         if self.args.dry_run:
             return
 
-        # get token
-        if not csrf:
-            response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/switch/number".format(source.id))
-            soup = BeautifulSoup(response.content, 'html.parser')
-            csrf = soup.find("input", {"id": "fonial_frontend_system_number__token"}).get("value")
-
-        response = self.session.post("https://kundenkonto.fonial.de/system/number/{}/switch/number".format(source.id), {
-            "fonial_frontend_system_number[unassign]": source.id,
-            "fonial_frontend_system_number[assign]": destination.id,
-            "fonial_frontend_system_number[_token]": csrf
-        })
+        response = self.tokens.submit("fonial_frontend_system_number", lambda: self.fetch_switch_token(source), lambda csrf: self.session.post(
+            self.url("/system/number/{}/switch/number".format(source.id)), {
+                "fonial_frontend_system_number[unassign]": source.id,
+                "fonial_frontend_system_number[assign]": destination.id,
+                "fonial_frontend_system_number[_token]": csrf
+            }))
 
         logging.debug(response.text)
-
-        if response.text != "{}":
-            logging.warning("FAILED SWITCHING {} -> {}".format(source, destination))
-
-        return csrf
+        self.cache.invalidate("numbers")  # the portal moves the assignments between both numbers
+        expect(response.text == "{}", "switching {} to {} failed: {}", source.number, destination.number, response.text[:200])
+
+        # the destination takes over the devices of the source which gets inactive
+        destination.targets, source.targets = source.targets, []
+        destination.assigned, source.assigned = source.assigned, False
+        destination.state, source.state = True, False
+        self.inventory.update_number(source)
+        self.inventory.update_number(destination)
+
+    def fetch_switch_token(self, source):
+        response = self.session.post(self.url("/system/number/{}/switch/number".format(source.id)))
+        return self.parser.input_value(response.content, id="fonial_frontend_system_number__token")
+
+    def read_switch_mapping(self):
+        mapping = {as_text(row["previous_number"]): as_text(row["number"]) for row in read_sheet(self.args.file) if row["previous_number"]}
+        logging.info("switching {} numbers".format(len(mapping)))
+        expect(mapping, "no rows with a previous number to switch in {}", self.args.file)
+        return mapping
 
     def switch_numbers(self):
-        # TODO change to xlsx format
-        with open(args.file, 'r', encoding='utf-8-sig', newline='') as src:
-            reader = csv.reader(src, delimiter=';', quotechar='"')
-            next(reader)  # skip header row
-
-            mapping = {row[5]: row[1] for row in reader}
-            logging.info("switching {} numbers".format(len(mapping)))
-            assert len(mapping) > 0
-
-            numbers = self.loadNumbers()
-            csrf = None
-
-            for a, b in mapping.items():
-                csrf = self.switch_number(numbers[a], numbers[b], csrf)
+        journal = self.journal("switch_numbers")
+        chains = self.switch_plan(journal)
+        if self.args.dry_run or not chains:
+            return chains
+
+        # the switches of a chain depend on each other and run in order, the chains run in parallel
+        failed = [(chain, error) for chain, error in zip(chains, self.run_batch(self.switch_chain, [(journal, chain) for chain in chains])) if error]
+        for chain, error in failed:
+            logging.warning("switching {} stopped: {}".format(", ".join("{} -> {}".format(a.number, b.number) for a, b in chain), error))
+        self.failed += ["switching {} stopped: {}".format(chain[0][0].number, error) for chain, error in failed]
+        return chains
+
+    def switch_plan(self, journal):
+        numbers = self.preflight(switching=True)
+        previous = [key for action, key in journal.planned if action == "chain"]
+        if previous:
+            # the portal is somewhere in the middle of the interrupted plan (e.g. a cycle parked on its spare number),
+            # so that plan is continued step by step instead of planning the sheet again
+            steps = [[step.split("->") for step in key.split(",")] for key in previous]
+            missing = sorted({x for chain in steps for step in chain for x in step if x not in numbers})
+            expect(not missing, "numbers {} of the interrupted switch plan are no longer in the fonial account", ", ".join(missing))
+            chains = [[(numbers[a], numbers[b]) for a, b in chain if not journal.done("switch", "{}->{}".format(a, b))] for chain in steps]
+            chains = [chain for chain in chains if chain]
+        else:
+            chains = self.plan_switches(self.read_switch_mapping(), numbers)
+            for chain in chains:
+                journal.write("planned", "chain", ",".join("{}->{}".format(a.number, b.number) for a, b in chain))
+        if not chains:
+            logging.info("all numbers already switched")
+            return chains
+
+        print("switch plan with {} independent chains:".format(len(chains)))
+        for chain in chains:
+            print("  {}".format(", ".join("{} -> {}".format(a.number, b.number) for a, b in chain)))
+        return chains
+
+    def switch_chain(self, journal, chain):
+        for a, b in chain:
+            journal.run("switch", "{}->{}".format(a.number, b.number), self.switch_number, a, b)
+
+    def plan_switches(self, mapping, numbers):
+        # a number is switched away at most once and receives at most one other number, so the mapping falls apart
+        # into chains (A -> B while B -> C) and cycles (A -> B while B -> A); a chain is switched from its end to free
+        # every destination before it is used and a cycle is broken through an unused spare number; with fewer spares
+        # than cycles, the cycles sharing a spare run one after another in the same chain
+        errors = []
+        sources = {}
+        for a, b in mapping.items():
+            if a not in numbers:
+                errors.append("{} not found in fonial account".format(a))
+            elif not numbers[a].state:
+                errors.append("can not switch the inactive number {}".format(a))
+            if b not in numbers:
+                errors.append("{} not found in fonial account".format(b))
+            elif numbers[b].state and b not in mapping:
+                errors.append("can not switch {} to the active number {}".format(a, b))
+            if b in sources:
+                errors.append("{} and {} are both switched to {}".format(sources[b], a, b))
+            if a == b:
+                errors.append("{} is switched to itself".format(a))
+            sources[b] = a
+        expect(not errors, "invalid switch plan:\n  {}", "\n  ".join(errors))
+
+        chains, planned = [], set()
+        for head in mapping:
+            if head in sources:
+                continue  # not the start of a chain
+            chain, a = [], head
+            while a in mapping:
+                planned.add(a)
+                chain.append((numbers[a], numbers[mapping[a]]))
+                a = mapping[a]
+            chains.append(chain[::-1])
+
+        spares = (n for n in numbers.values() if not n.state and not n.cancelled and not n.targets and n.number not in mapping and n.number not in sources)
+        broken, reused = [], 0  # (spare, switches) per spare number in use
+        for head in mapping:
+            if head in planned:
+                continue
+            cycle, a = [], head
+            while a not in planned:
+                planned.add(a)
+                cycle.append((numbers[a], numbers[mapping[a]]))
+                a = mapping[a]
+            spare = next(spares, None)
+            if spare is not None:
+                broken.append((spare, []))
+                spare, switches = broken[-1]
+            else:
+                expect(broken, "no unused number left to break the cycle starting at {}", head)
+                # a spare is unused again after its cycle, so the remaining cycles take turns on the spares in use
+                spare, switches = broken[reused % len(broken)]
+                reused += 1
+            # park the last source on the spare, switch the rest of the cycle as a chain, then move the spare on
+            last, first = cycle[-1]
+            switches += [(last, spare)] + cycle[-2::-1] + [(spare, first)]
+        return chains + [switches for spare, switches in broken]
+
+    def try_read_user_device(self, user):
+        # a single broken device page ends up in the report instead of stopping the verification
+        try:
+            return self.read_user_device(user)
+        except FonialError as e:
+            logging.warning("{}: {}".format(user.name, e))
+            return ["failed: {}".format(e)]
 
-    def  verify_user(self, user):
+    def read_user_device(self, user):
         logging.debug("verifying user {}".format(user))
 
         if user.fonial_device is None:
             logging.info("{}: no device configured".format(user.name))
-            return
+            return None
 
-        response = self.session.get("https://kundenkonto.fonial.de/system/device/{}/ipdevice/edit".format(user.fonial_device.id))
-        soup = BeautifulSoup(response.content, 'html.parser')
-        # logging.debug(soup.prettify())
-        assert soup.form.get("name") == "fonial_frontend_device_ip_device"
+        response = self.session.get(self.url("/system/device/{}/ipdevice/edit".format(user.fonial_device.id)))
+        form, fields = self.parser.form_fields(response.content)
+        expect(form == "fonial_frontend_device_ip_device", "{}: device form of {} not found", user.name, user.fonial_device)
 
         errors = []
-        target_name = soup.find("input", id="fonial_frontend_device_ip_device_targetName").get("value")
+        target_name = fields.get("fonial_frontend_device_ip_device_targetName")
         if target_name != user.name:
             errors.append("target_name")
             logging.warning("{}: wrong device name {}".format(user.name, target_name))
 
-        mac_address = soup.find("input", id="fonial_frontend_device_ip_device_mac").get("value")
-        if mac_address != user.mac_address:
+        mac_address = fields.get("fonial_frontend_device_ip_device_mac")
+        if normalize_mac(mac_address) != normalize_mac(user.mac_address):
             errors.append("mac_address")
             logging.warning("{}: wrong device mac address {}. {} expected".format(user.name, mac_address, user.mac_address))
 
-        num_list = soup.find("select", id="fonial_frontend_device_ip_device_outboundnum")
-        outbound_num = num_list.find("option", selected=True).string
+        outbound_num = fields.get("fonial_frontend_device_ip_device_outboundnum") or ""
         if outbound_num[-9:] != user.number:
             errors.append("outbound_num")
             logging.warning("{}: wrong outbound {}. {} expected".format(user.name, outbound_num, user.number))
 
-        extension = int(soup.find("input", id="fonial_frontend_device_ip_device_internalext").get("value"))
-        if extension != user.extension:
+        extension = as_int(fields.get("fonial_frontend_device_ip_device_internalext"))
+        if extension is None:
+            errors.append("extension")
+            logging.warning("{}: no extension on the device page. {} expected".format(user.name, user.extension))
+        elif extension != user.extension:
             errors.append("extension")
             logging.warning("{}: wrong extension {}. {} expected".format(user.name, extension, user.extension))
 
-        csrf = soup.find("input", id="fonial_frontend_device_ip_device__token").get("value")
-        assert csrf is not None
-        logging.debug("found CSRF token {}".format(csrf))
+        # keep the token of the device form for a following update
+        self.tokens.put("fonial_frontend_device_ip_device", fields.get("fonial_frontend_device_ip_device__token"))
 
         if len(errors) == 0:
             logging.info("{}: all fine".format(user.name))
         else:
             logging.warning("{}: found errors {}".format(user.name, errors))
 
-        # fix outbound num issue
-        if len(errors) == 1 and errors[0] == "outbound_num":
-            self.bind_number_to_device(user.name, user.fonial_device, user.fonial_number, csrf)
+        return errors
 
+    def read_employees(self, numbers, devices):
+        for row in read_sheet(self.args.file):
+            number = as_text(row["number"])
+            mac_address = normalize_mac(as_text(row["mac_address"]))
+            n = numbers.get(number)
+            d = devices.get(mac_address)
+            yield Employee(row["name"], number, as_int(row["extension"]), mac_address, n, d,
+                           as_text(row["status"]), as_text(row["previous_number"]))
+
+    def fingerprint(self, user):
+        n, d = user.fonial_number, user.fonial_device
+        return Fingerprints.of(user.name, user.number, user.extension, user.mac_address, d.record() if d else None, n.record() if n else None)
+
+    def verify(self):
+        return self.check_number_mapping(self.preflight(), self.loadDevices())
 
     def check_number_mapping(self, numbers, devices):
-        wb = load_workbook(self.args.file, data_only=True)
-        ws = wb.active
-        # for i, row in enumerate(ws.values):
-        for i, row in zip(range(200), ws.values):
-            if i < 1:
-                continue  # skip header row
-            name = row[7]
-            number = str(row[8])
-            extension = row[9]
-            mac_address = row[10]
-            n = numbers[number] if number in numbers else None
-            d = devices[mac_address] if mac_address is not None and mac_address in devices else None
-            user = Employee(name, number, extension, mac_address, n, d)
-            f.verify_user(user)
-
-    def deactivate_unused_numbers(self):
-        numbers = self.loadNumbers()
-        for n in numbers.values():
-            if n.state and not n.assigned and not n.cancelled:
-                f.deactivateNumber(n)
+        fingerprints = Fingerprints(self.args.cache_dir, self.args.account, self.args.verify_max_age, self.args.refresh)
+        users = [user for user in self.read_employees(numbers, devices)
+                 if user.fonial_device is None or fingerprints.stale(user.fonial_device.id, self.fingerprint(user))]
+        logging.info("{} users changed or due for verification".format(len(users)))
+
+        # read phase: fetch and compare all device edit pages in parallel (the pool threads share the logged in session)
+        with ThreadPoolExecutor(max_workers=self.args.workers) as pool:
+            results = list(pool.map(self.try_read_user_device, users))
+
+        # only devices without errors are skipped next time
+        for user, errors in zip(users, results):
+            if errors == []:
+                fingerprints.put(user.fonial_device.id, self.fingerprint(user))
+            elif user.fonial_device is not None:
+                fingerprints.drop(user.fonial_device.id)
+        fingerprints.save()
+
+        report = {user.name: errors for user, errors in zip(users, results) if errors}
+        logging.info("verified {} users, {} with errors".format(len(users), len(report)))
+        for name, errors in report.items():
+            logging.warning("{}: {}".format(name, ", ".join(errors)))
+
+        # fix phase: only after all reads are done
+        for user, errors in zip(users, results):
+            if errors == ["outbound_num"]:
+                try:
+                    self.bind_number_to_device(user.name, user.fonial_device, user.fonial_number)
+                except FonialError as e:
+                    logging.warning("{}: {}".format(user.name, e))
+                    report[user.name] = errors + ["fix failed: {}".format(e)]
+                    self.failed.append("{}: {}".format(user.name, e))
+
+        return report
+
+    ## SPREADSHEET CHECKS
+
+    def validate(self):
+        columns = read_columns(self.args.file)
+        problems = self.check_sheet(columns) + self.check_numbers(columns, self.loadNumbers())
+        for problem in problems:
+            print(problem)
+        print("{} rows checked, {} problems found".format(len(columns["row"]), len(problems)))
+        return problems
+
+    def preflight(self, required=(), switching=False):
+        # checks the whole sheet before the first change: the local checks even before the first request,
+        # returns the loaded numbers
+        columns = read_columns(self.args.file)
+        problems = self.check_sheet(columns, required)
+        if switching and not any(columns["previous_number"]):
+            problems.append("no rows with a previous number to switch")
+        numbers = None
+        if not problems:
+            numbers = self.loadNumbers()
+            problems = self.check_numbers(columns, numbers)
+        for problem in problems:
+            logging.error(problem)
+        expect(not problems, "{} problems in {}, nothing was changed", len(problems), self.args.file)
+        return numbers
 
-    def export(self):
-        wb = Workbook()
-        ws = wb.active
-        # append header
-        ws.append(["Firstname", "Lastname", "Name", "Number", "Extension", "Mac-Address", "Type", "Status", "Handed over to user", "When", "Returned to", "When", "Remarks"])
-        numbers = self.loadNumbers()
+    def check_sheet(self, columns, required=()):
+        lines = columns["row"]
+        active = [as_text(status) != "delete" for status in columns["status"]]
+        problems = []
+
+        for field in required:
+            problems += ["row {}: no {}".format(line, field.replace("_", " ")) for line, value in zip(lines, columns[field]) if value is None]
+
+        macs = [normalize_mac(as_text(value)) for value in columns["mac_address"]]
+        problems += ["row {}: invalid mac address {}".format(line, value)
+                     for line, value, mac in zip(lines, columns["mac_address"], macs) if mac is not None and not MAC_ADDRESS.fullmatch(mac)]
+        problems += duplicates(lines, [mac if a else None for mac, a in zip(macs, active)], "mac address")
+
+        numbers = [as_text(value) for value in columns["number"]]
+        valid = [number is not None and number.isdigit() and len(number) >= 3 for number in numbers]
+        problems += ["row {}: invalid phone number {}".format(line, number)
+                     for line, number, ok in zip(lines, numbers, valid) if number is not None and not ok]
+        problems += duplicates(lines, [number if a else None for number, a in zip(numbers, active)], "phone number")
+
+        extensions = [as_int(value) for value in columns["extension"]]
+        problems += ["row {}: invalid extension {}".format(line, value)
+                     for line, value, extension in zip(lines, columns["extension"], extensions) if value is not None and extension is None]
+        problems += duplicates(lines, [extension if a else None for extension, a in zip(extensions, active)], "extension")
+
+        # switching rows: previous number -> number
+        previous = [as_text(value) for value in columns["previous_number"]]
+        problems += ["row {}: no number to switch {} to".format(line, a) for line, a, b in zip(lines, previous, numbers) if a and not b]
+        problems += ["row {}: {} is switched to itself".format(line, a) for line, a, b in zip(lines, previous, numbers) if a and a == b]
+        problems += duplicates(lines, previous, "previous number")
+        problems += duplicates(lines, [b if a else None for a, b in zip(previous, numbers)], "switch target")
+        return problems
+
+    def check_numbers(self, columns, numbers):
+        # numbers of rows marked for deletion may already be gone from the account
+        active = [as_text(status) != "delete" for status in columns["status"]]
+        problems = []
+        for field in ("number", "previous_number"):
+            problems += ["row {}: {} {} not found in fonial account".format(line, field.replace("_", " "), as_text(value))
+                         for line, value, a in zip(columns["row"], columns[field], active) if a and value is not None and as_text(value) not in numbers]
+        return problems
+
+    ## SYNC
+
+    def sync(self):
+        # phase one: read everything once and compute the plan
+        numbers = self.preflight()
         devices = self.loadDevices()
-        for n in numbers.values():
-            d = devices[n.mac_address]
-            ws.append([
-                "",
-                "",
-                d.mac_address,
-                n.number,
-                n.extension,
-                d.mac_address,
-                d.type,
-                "DEPLOYED",  # must be DEPLOYED, STORAGE or NO DEVICE - anything else than DEPLOYED?
-                "?",
-                "?",
-                "",
-                "",
-                ""
-            ])
-        wb.save(filename=self.args.file)
+        users = list(self.read_employees(numbers, devices))
+        plan = self.plan_sync(users, numbers, devices)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Fonial admin batch tool')
-    parser.add_argument('-a', '--account', required=True,
+        print("sync plan with {} actions:".format(len(plan)))
+        for action in plan:
+            print("  {}".format(action))
+        if self.args.dry_run:
+            return plan
+
+        # phase two: execute the plan stage by stage, the actions of a stage in parallel
+        self.execute("sync", plan)
+        return plan
+
+    def execute(self, job, plan):
+        journal = self.journal(job)
+        for action in plan:
+            journal.write("planned", action.kind, action.subject)
+        # a failed action does not stop the later stages, all failures are reported at the end
+        failed = []
+        for kind in Fonial.SYNC_STAGES:
+            stage = [action for action in plan if action.kind == kind and not journal.done(action.kind, action.subject)]
+            if stage:
+                logging.info("{} {} actions".format(len(stage), kind))
+                errors = self.run_batch(lambda action: journal.run(action.kind, action.subject, action), [(action,) for action in stage])
+                failed += [(action, error) for action, error in zip(stage, errors) if error]
+
+        if failed:
+            print("{} of {} actions failed:".format(len(failed), len(plan)))
+            for action, error in failed:
+                print("  {}: {}".format(action, error))
+        self.failed += ["{}: {}".format(action, error) for action, error in failed]
+        return failed
+
+    SYNC_STAGES = ["activate", "switch", "create", "update", "bind", "delete", "deactivate"]
+
+    def plan_sync(self, users, numbers, devices):
+        # a device or number still listed by an active row is kept even if another row marks it for deletion
+        wanted = {user.number for user in users if user.status != "delete"}
+        wanted_macs = {user.mac_address for user in users if user.status != "delete" and user.mac_address}
+
+        plan = []
+        activated = set()
+        for user in users:
+            n, d = user.fonial_number, user.fonial_device
+
+            if user.status == "delete":
+                if d and normalize_mac(d.mac_address) not in wanted_macs:
+                    plan.append(Action("delete", "device {} of {}".format(d, user.name), self.delete_device, d))
+                if n and n.state and not n.cancelled and n.number not in wanted:
+                    plan.append(Action("deactivate", "number {} of {}".format(n.number, user.name), self.deactivateNumber, n))
+                continue
+
+            if user.mac_address is None:
+                logging.warning("{}: no mac address, skipped".format(user.name))
+                continue
+            if n is None:
+                logging.warning("{}: number {} not found in fonial account, skipped".format(user.name, user.number))
+                continue
+            others = [m.number for m in self.inventory.numbers_with_extension(n.extension) if m is not n and (m.number in wanted or m.assigned)]
+            if others:
+                logging.warning("{}: extension {} already used by {}".format(user.name, n.extension, ", ".join(others)))
+
+            current = self.inventory.number_of_device(d) if d else None
+            if d and current is not None and current is not n:
+                # moving the device to an unused number in one step frees the old number at the same time
+                if current.state and current.number not in wanted and not n.state and not n.targets:
+                    plan.append(Action("switch", "{} -> {} for {}".format(current.number, n.number, user.name), self.switch_number, current, n))
+                    continue
+
+            if not n.state and n.number not in activated:
+                activated.add(n.number)
+                plan.append(Action("activate", "number {} for {}".format(n.number, user.name), self.activateNumber, n))
+
+            if d is None:
+                plan.append(Action("create", "device {} for {} with number {}".format(user.mac_address, user.name, n.number), self.new_device, user.name, user.mac_address, n))
+                continue
+
+            if current is not n:
+                plan.append(Action("update", "outbound number of {} to {}".format(user.name, n.number), self.bind_number_to_device, user.name, d, n))
+            if d.id not in n.targets:
+                plan.append(Action("bind", "number {} to device {} of {}".format(n.number, d.id, user.name), self.bind_device_to_number, n, d.id))
+
+        return plan
+
+    ## CLEAN UP
+
+    def clean(self):
+        # deletes and deactivations can not be undone, so they are never planned from a cached listing
+        self.cache.refresh = True
+        numbers = self.preflight()
+        devices = self.loadDevices()
+        plan = self.plan_clean(numbers, devices)
+
+        print("clean up plan with {} actions:".format(len(plan)))
+        for action in plan:
+            print("  {}".format(action))
+        if self.args.dry_run:
+            return plan
+
+        self.execute("clean", plan)
+        return plan
+
+    def plan_clean(self, numbers, devices):
+        # everything the spreadsheet still lists is kept
+        wanted_numbers, wanted_macs = set(), set()
+        for row in read_sheet(self.args.file):
+            if as_text(row["status"]) == "delete":
+                continue
+            if row["number"]:
+                wanted_numbers.add(as_text(row["number"]))
+            if row["mac_address"]:
+                wanted_macs.add(normalize_mac(as_text(row["mac_address"])))
+        # an empty sheet or a missing mac address column would delete every device of the account
+        expect(wanted_macs, "no mac addresses found in {}, nothing was changed", self.args.file)
+
+        plan, deleted = [], set()
+        for d in list(devices.values()):
+            bound = self.inventory.number_of_device(d) is not None
+            if normalize_mac(d.mac_address) not in wanted_macs:
+                plan.append(Action("delete", "device {} without spreadsheet row{}".format(d, "" if bound else " and number"), self.delete_device, d))
+                deleted.add(d.id)
+            elif not bound:
+                logging.info("device {} has no number but is listed in the spreadsheet, kept".format(d))
+        # numbers only bound to deleted devices become unassigned with this plan as well
+        unused = set(n.id for n in self.inventory.unused_numbers())
+        for n in list(numbers.values()):
+            if n.number in wanted_numbers or not n.state or n.cancelled:
+                continue
+            if n.id in unused:
+                plan.append(Action("deactivate", "unassigned number {}".format(n.number), self.deactivateNumber, n))
+            elif n.targets and all(t in deleted for t in n.targets):
+                plan.append(Action("deactivate", "number {} of deleted devices".format(n.number), self.deactivateNumber, n))
+        return plan
+
+    EXPORT_HEADER = ["Firstname", "Lastname", "Name", "Number", "Extension", "Mac-Address", "Type", "Status", "Handed over to user", "When", "Returned to", "When", "Remarks"]
+
+    def export(self):
+        self.loadDevices()
+        devices = self.inventory.devices
+        deployed = set()
+
+        def rows():
+            # numbers are joined to their devices through the number targets while the pages come in
+            for n in self.iterNumbers():
+                targets = [devices[t] for t in n.targets if t in devices]
+                for d in targets:
+                    deployed.add(d.id)
+                    yield ["", "", d.name, n.number, n.extension, d.mac_address, d.type, "DEPLOYED", "?", "?", "", "", ""]
+                if not targets and n.state and not n.cancelled:
+                    yield ["", "", "", n.number, n.extension, "", "", "NO DEVICE", "", "", "", "", ""]
+            for d in devices.values():
+                if d.id not in deployed:
+                    yield ["", "", d.name, "", "", d.mac_address, d.type, "STORAGE", "", "", "", "", ""]
+
+        if self.args.file.lower().endswith(".csv"):
+            with open(self.args.file, 'w', encoding='utf-8-sig', newline='') as dst:
+                writer = csv.writer(dst, delimiter=';', quotechar='"')
+                writer.writerow(Fonial.EXPORT_HEADER)
+                writer.writerows(rows())
+        else:
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet()
+            ws.append(Fonial.EXPORT_HEADER)
+            for row in rows():
+                ws.append(row)
+            wb.save(filename=self.args.file)
+        logging.info("exported {} devices into {}".format(len(devices), self.args.file))
+
+def build_parser():
+    # options of every command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-a', '--account', required=False,
                         help='the fonial account id (usually 6 digit id)')
-    parser.add_argument('-u', '--user', required=True,
+    common.add_argument('-u', '--user', required=False,
                         help='the fonial backend username (usually an email address)')
-    parser.add_argument('-p', '--password', required=False,
+    common.add_argument('-p', '--password', required=False,
                         help='the fonial backend users password')
-    parser.add_argument('-e', '--export', action="store_true", default=False,
-                        help='export the current data in fonial into the specified file')
-    parser.add_argument('-c', '--clean', required=False,
-                        help='deactivate unused numbers')
-    parser.add_argument('-s', '--switch-numbers', required=False,
-                        help='switch current numbers if possible - previous numbers get invalid immediately')
-    parser.add_argument('-d', '--debug', action="store_true", default=False,
+    common.add_argument('-d', '--debug', action="store_true", default=False,
                         help='set debug mode')
-    parser.add_argument('-n', '--dry-run', action="store_true", default=False,
+    common.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of parallel requests against the fonial portal (default 8)')
+    common.add_argument('-r', '--rate', type=float, default=10,
+                        help='maximum requests per second against the fonial portal, 0 for unlimited (default 10)')
+    common.add_argument('--session-dir', default='~/.fonial/sessions',
+                        help='directory of the stored login sessions (default ~/.fonial/sessions)')
+    common.add_argument('--retries', type=int, default=4,
+                        help='retries of failed or throttled requests with exponential backoff (default 4)')
+    common.add_argument('--timeout', type=float, default=30,
+                        help='request timeout in seconds, the number and device lists get 120 (default 30)')
+    common.add_argument('--cache-dir', default='.fonial-cache',
+                        help='directory of the local numbers and devices cache (default .fonial-cache)')
+    common.add_argument('--cache-ttl', type=int, default=3600,
+                        help='seconds until the cached numbers and devices get reloaded (default 3600)')
+    common.add_argument('--refresh', action="store_true", default=False,
+                        help='ignore the cached numbers and devices and reload them from fonial')
+    common.add_argument('--verify-max-age', type=int, default=7 * 24 * 3600,
+                        help='seconds until an unchanged device gets verified again (default one week), --refresh verifies all')
+    common.add_argument('--parser', choices=["auto"] + list(PARSERS), default="auto",
+                        help='html parser backend, auto uses lxml if it is installed (default auto)')
+    common.add_argument('--base-url', default='https://kundenkonto.fonial.de',
+                        help='base url of the fonial portal (default https://kundenkonto.fonial.de)')
+    common.add_argument('--resume', action="store_true", default=False,
+                        help='continue an interrupted bulk job and skip the actions its journal lists as done')
+    common.add_argument('--metrics', required=False,
+                        help='also write the request metrics to this file, JSON if it ends in .json, otherwise prometheus textfile format')
+    common.add_argument('-n', '--dry-run', action="store_true", default=False,
                         help='perform a trial run with no changes made')
-    parser.add_argument('file',
-                        help='the fonial excel file')
+    common.add_argument('--accounts', required=False,
+                        help='run the command for every account listed in this JSON file instead of -a/-u/file')
+    common.add_argument('--tenants', type=int, default=4,
+                        help='accounts processed at the same time in multi account mode (default 4)')
+    common.add_argument('--max-connections', type=int, default=16,
+                        help='requests in flight over all accounts in multi account mode, --rate applies to all of them together (default 16)')
+
+    parser = argparse.ArgumentParser(description='Fonial admin batch tool')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for name, (method, help) in COMMANDS.items():
+        command = commands.add_parser(name, parents=[common], help=help, description=help)
+        command.add_argument('file', nargs='?',
+                             help='the file to write' if name == "export" else 'the fonial excel or csv file')
+    return parser
+
+# command -> (Fonial method, help)
+COMMANDS = {
+    "export": ("export", "export the current data in fonial into the specified file"),
+    "sync": ("sync", "bring fonial in line with the spreadsheet: activate, switch, create, update, bind, delete and deactivate"),
+    "verify": ("verify", "compare the devices in fonial with the spreadsheet and fix wrong outbound numbers"),
+    "switch": ("switch_numbers", "switch current numbers to the new ones - previous numbers get invalid immediately"),
+    "clean": ("clean", "deactivate unassigned numbers and delete devices without spreadsheet row"),
+    "provision": ("new_devices", "create the devices listed in the spreadsheet and activate their numbers"),
+    "validate": ("validate", "check mac addresses, numbers, extensions and switch targets of the spreadsheet without changing anything"),
+}
+
+def run(f):
+    return getattr(f, COMMANDS[f.args.command][0])()
+
+def account_password(entry):
+    # credentials are only referenced from the accounts file: an environment variable or a file readable by the user
+    if "password_env" in entry:
+        password = os.environ.get(entry["password_env"])
+        expect(password is not None, "environment variable {} of account {} not set", entry["password_env"], entry["account"])
+        return password
+    if "password_file" in entry:
+        with open(os.path.expanduser(entry["password_file"]), 'r') as f:
+            return f.read().strip()
+    return None  # asked on the terminal before the accounts start
+
+def run_accounts(args):
+    # accounts file: {"accounts": [{"account": "123456", "user": "admin@example.com", "password_env": "FONIAL_123456",
+    #                               "file": "123456.xlsx", "options": {"command": "export"}}, ...]}
+    # every account runs in its own thread with its own session, cache and journal files; rate and connections are
+    # limited for all of them together
+    with open(args.accounts, 'r') as f:
+        accounts = json.load(f)["accounts"]
+    limiter = RateLimiter(args.rate)
+    gate = threading.BoundedSemaphore(args.max_connections)
+    metrics = Metrics()
+
+    def credentials(entry):
+        try:
+            return account_password(entry) or args.password or getpass("password for {} of account {}".format(entry["user"], entry["account"]))
+        except (FonialError, IOError) as e:
+            return e
+
+    # the missing passwords are asked one after the other, the account threads would prompt on the terminal at once
+    passwords = [credentials(entry) for entry in accounts]
+
+    def tenant(entry, password):
+        tenant_args = argparse.Namespace(**vars(args))
+        tenant_args.accounts = tenant_args.metrics = None
+        tenant_args.account, tenant_args.user, tenant_args.file = str(entry["account"]), entry["user"], entry.get("file", args.file)
+        vars(tenant_args).update(entry.get("options", {}))
+        threading.current_thread().name = "account-{}".format(entry["account"])
+        started = time.monotonic()
+        f = None
+        try:
+            if isinstance(password, Exception):
+                raise password
+            tenant_args.password = password
+            f = Fonial(tenant_args, limiter=limiter, gate=gate)
+            result = run(f)
+            if tenant_args.command == "validate" and result:
+                return "failed: {} problems in {}".format(len(result), tenant_args.file), time.monotonic() - started
+            if f.failed:
+                return "failed: {} actions failed".format(len(f.failed)), time.monotonic() - started
+            return "ok", time.monotonic() - started
+        except Exception as e:
+            # a broken workbook or portal page of one account must not lose the results of the others
+            logging.error("account {} failed: {}".format(entry["account"], e), exc_info=not isinstance(e, FonialError))
+            return "failed: {}".format(str(e) or type(e).__name__).splitlines()[0], time.monotonic() - started
+        finally:
+            if f is not None:
+                metrics.merge(f.metrics)
+
+    with ThreadPoolExecutor(max_workers=args.tenants) as pool:
+        results = list(pool.map(tenant, accounts, passwords))
+
+    print("{:<12} {:<32} {:>9}  {}".format("account", "user", "seconds", "result"))
+    for entry, (result, seconds) in zip(accounts, results):
+        print("{:<12} {:<32} {:>9.1f}  {}".format(entry["account"], entry["user"], seconds, result))
+    print(metrics.summary())
+    if args.metrics:
+        metrics.write(args.metrics)
+    return all(result == "ok" for result, seconds in results)
+
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
 
-    if not args.password:
-        args.password = getpass("password for {}".format(args.user))
+    if args.accounts:
+        logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+        raise SystemExit(0 if run_accounts(args) else 1)
+    if not (args.account and args.user and args.file):
+        parser.error("-a/--account, -u/--user and file are required without --accounts")
 
     f = Fonial(args)
 
-    if args.export:
-        f.export()
-    else:
-        f.sync()
-
-    # numbers = f.loadNumbers()
-    # devices = f.loadDevices()
-
-    # wb = load_workbook(args.file, data_only=True)
-    # ws = wb.active
-    # for i, row in enumerate(ws.values):
-    # # for i, row in zip(range(2), ws.values):
-    #     if i < 1:
-    #         continue  # skip header row
-    #     if row[13] == 'delete':
-    #         name = row[7]
-    #         number = str(row[8])
-    #         mac_address = row[10]
-    #         d = devices[mac_address] if mac_address is not None and mac_address in devices else None
-    #         n = numbers[number] if number in numbers else None
-    #         if d:
-    #             f.delete_device(d)
-    #         if n:
-    #             f.deactivateNumber(n)
-
-    # f.check_number_mapping(numbers, devices)
-    # f.newDevices()
+    try:
+        result = run(f)
+    finally:
+        f.report()
+    if args.command == "validate" and result:
+        raise SystemExit(1)  # usable as a pre-flight gate in scripts
+    if f.failed:
+        raise SystemExit(1)